@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+"""Benchmark the bibliography tools on synthetic bib and aux files.
+
+    Times each phase of cleanRefs.py (aux scan, parse, checks, duplicate detection, rewrite) and of pas-bib.py
+    (getDocInfoFromBib, generateBib) on seeded corpora of increasing size, records the peak memory of each phase,
+    and writes the results as JSON. A previous results file can be given to flag regressions beyond a threshold.
+
+    pas-bib.py is Python 2 and needs the ldap module: it is run under a separate Python 2 interpreter, and skipped
+    (with the reason in the results) if that is not available.
+    """
+
+__version__ = "1.0"
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cleanRefs
+
+_sizes = (1000, 10000, 100000)
+_tag = 'XXX-00-000'
+
+_surnames = ('Krupa', 'Duarte', 'Wang', 'Qu', 'Pedro', 'Harris', 'Tran', 'Bocci', 'Pantaleo', 'Rovere', 'Holzman',
+             'Knoepfel', 'Cacciari', 'Salam', 'Soyez', 'Kortelainen', 'Innocente', 'Hawks', 'Yang', 'Gouskos')
+_givenNames = ('Jeffrey', 'Javier', 'Michael', 'Huilin', 'Kevin', 'Philip', 'Nhan', 'Andrea', 'Felice', 'Marco',
+               'Burt', 'Kyle', 'Matteo', 'Gavin', 'Gregory', 'Matti', 'Vincenzo', 'Benjamin', 'Tingjun', 'Loukas')
+_words = ('GPU', 'coprocessors', 'as', 'a', 'service', 'for', 'deep', 'learning', 'inference', 'in', 'high', 'energy',
+          'physics', 'performance', 'of', 'missing', 'transverse', 'momentum', 'reconstruction', 'proton-proton',
+          'collisions', 'heterogeneous', 'tracks', 'primary', 'vertices', 'with', 'the', 'pixel', 'tracker',
+          'jet', 'tagging', 'graph', 'neural', 'networks', 'FPGA-accelerated', 'machine', 'computing', 'trigger',
+          'search', 'measurement', 'boosted', 'particles', 'neutrino', 'experiments', 'detector', 'upgrade')
+_syllables = ('ka', 'lo', 'ri', 'mu', 'ten', 'sor', 'flux', 'ion', 'tra', 'jet', 'gra', 'phi', 'ne', 'tron', 'dy',
+              'nam', 'ic', 'al', 'ver', 'tex', 'cal', 'or', 'im', 'ter', 'quark', 'lep', 'ton', 'bo', 'son', 'hi')
+_journals = (('JINST', 'P'), ('Mach. Learn. Sci. Tech.', ''), ('Comput. Softw. Big Sci.', ''), ('Phys. Rev. D', ''),
+             ('Eur. Phys. J. C', ''), ('JHEP', ''), ('Front. Big Data', ''), ('Phys. Lett. B', ''))
+_classes = ('hep-ex', 'hep-ph', 'physics.comp-ph', 'physics.data-an', 'physics.ins-det', 'cs.DC', 'cs.LG')
+_groups = ('BPH', 'EXO', 'HIG', 'JME', 'MLG', 'SMP', 'SUS', 'TOP', 'TRK', 'BTV')
+
+
+class corpus(object):
+    """ Seeded generator of bib files shaped like the entries of ML-23-YYY.bib (INSPIRE-style articles, aligned
+        collaboration papers, CMS notes as techreports, web resources as misc), with the matching aux file.
+
+        A small fraction of the entries repeat the DOI of an earlier entry, or are a lightly edited copy of one,
+        so that the duplicate checks have something to find.
+    """
+
+    def __init__(self, seed):
+        """
+        :param seed: seed of the random generator: the same seed always gives the same files
+        """
+        self._seed = seed
+        # real titles draw on a far larger vocabulary than _words: pad it out with made-up terms, so that
+        # unrelated titles are no more alike than they are in a real bib file
+        rng = random.Random(seed)
+        self._terms = sorted(set(''.join(rng.choice(_syllables) for i in range(rng.randint(2, 4))) for j in range(5000)))
+
+    def title(self, rng):
+        """ A random title, sometimes wrapped across lines as in hand-edited bib files """
+        words = [rng.choice(_words) if rng.random() < 0.4 else rng.choice(self._terms) for i in range(rng.randint(5, 14))]
+        words[0] = words[0].capitalize()
+        if len(words) > 10 and rng.random() < 0.3:
+            words[8] = '\n                        ' + words[8]
+        return ' '.join(words)
+
+    def authors(self, rng):
+        """ A random author list, as INSPIRE writes it """
+        names = ['{0}, {1}'.format(rng.choice(_surnames), rng.choice(_givenNames)) for i in range(rng.randint(1, 12))]
+        if len(names) > 8:
+            return names[0] + ' and others'
+        return ' and '.join(names)
+
+    def entry(self, rng, key, kind):
+        """ One bib entry of the given kind
+
+        :param rng: random generator
+        :param key: bib key
+        :param kind: one of 'article', 'collaboration', 'techreport', 'misc'
+        :return: the entry text and its DOI (or None)
+        """
+        year = rng.randint(2008, 2023)
+        eprint = '{0:02d}{1:02d}.{2:05d}'.format(year % 100, rng.randint(1, 12), rng.randint(0, 99999))
+        doi = None
+        if kind == 'article':
+            (journal, prefix) = rng.choice(_journals)
+            doi = '10.{0}/{1}'.format(rng.randint(1000, 9999), rng.randint(10**6, 10**7))
+            return ('@article{{{0},\n'
+                    '    author = "{1}",\n'
+                    '    title = "{{{2}}}",\n'
+                    '    eprint = "{3}",\n'
+                    '    archivePrefix = "arXiv",\n'
+                    '    primaryClass = "{4}",\n'
+                    '    doi = "{5}",\n'
+                    '    journal = "{6}",\n'
+                    '    volume = "{7}",\n'
+                    '    pages = "{8}{9}",\n'
+                    '    year = "{10}"\n'
+                    '}}\n').format(key, self.authors(rng), self.title(rng), eprint, rng.choice(_classes), doi, journal,
+                                   rng.randint(1, 99), prefix, rng.randint(1, 99999), year), doi
+        if kind == 'collaboration':
+            doi = '10.1088/1748-0221/{0}/{1:02d}/P{1:02d}{2:03d}'.format(year % 100, rng.randint(1, 12), rng.randint(0, 999))
+            return ('@article{{{0},\n'
+                    '      author         = "{1}",\n'
+                    '      title          = "{2}",\n'
+                    '      collaboration  = "CMS",\n'
+                    '      journal        = "JINST",\n'
+                    '      volume         = "{3}",\n'
+                    '      year           = "{4}",\n'
+                    '      pages          = "P{5:05d}",\n'
+                    '      doi            = "{6}",\n'
+                    '      eprint         = "{7}",\n'
+                    '      archivePrefix  = "arXiv",\n'
+                    '      primaryClass   = "hep-ex",\n'
+                    '      reportNumber   = "CMS-{8}-{9:02d}-{10:03d}, CERN-EP-{4}-{11:03d}",\n'
+                    '      SLACcitation   = "%%CITATION = ARXIV:{7};%%"\n'
+                    '}}\n').format(key, self.authors(rng), self.title(rng), year % 100, year, rng.randint(0, 99999),
+                                   doi, eprint, rng.choice(_groups), year % 100, rng.randint(1, 999),
+                                   rng.randint(1, 999)), doi
+        if kind == 'techreport':
+            return ('@techreport{{{0},\n'
+                    '  collaboration = {{CMS}},\n'
+                    '  number        = {{{0}}},\n'
+                    '  title         = {{{{{1}}}}},\n'
+                    '  type          = {{CMS Physics Analysis Summary}},\n'
+                    '  url           = {{https://cds.cern.ch/record/{2}}},\n'
+                    '  year          = {{{3}}}\n'
+                    '}}\n').format(key, self.title(rng), rng.randint(10**6, 3 * 10**6), year), None
+        doi = '10.48550/ARXIV.{0}'.format(eprint)
+        return ('@misc{{{0},\n'
+                '  doi = {{{1}}},\n'
+                '  url = {{https://arxiv.org/abs/{2}}},\n'
+                '  author = {{{3}}},\n'
+                '  title = {{{4}}},\n'
+                '  eprint = "{2}",\n'
+                '  archivePrefix = "arXiv",\n'
+                '  primaryClass = "{5}",\n'
+                '  year = {{{6}}},\n'
+                '}}\n').format(key, doi, eprint, self.authors(rng), self.title(rng), rng.choice(_classes), year), doi
+
+    def key(self, rng, kind, keys):
+        """ A new, unique, bib key in the style of the entry kind """
+        while True:
+            if kind == 'techreport':
+                key = 'CMS-PAS-{0}-{1:02d}-{2:03d}'.format(rng.choice(_groups), rng.randint(10, 23), rng.randint(1, 999))
+            else:
+                key = '{0}:{1}{2}'.format(rng.choice(_surnames), rng.randint(2008, 2023),
+                                          ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for i in range(3)))
+            if key not in keys:
+                keys.add(key)
+                return key
+
+    def generate(self, size, directory, tag=_tag):
+        """ Write auto_generated.bib, with size entries, and the aux file citing most of them, as cleanRefs reads them
+
+        :param size: number of bib entries
+        :param directory: where to write the files
+        :param tag: document tag, naming the aux file
+        :return: list of the bib keys
+        """
+        rng = random.Random('{0}:{1}'.format(self._seed, size))
+        keys = set()
+        order = []
+        texts = []
+        dois = []
+        for i in range(size):
+            kind = rng.choice(('article', 'article', 'article', 'collaboration', 'collaboration', 'techreport', 'misc'))
+            key = self.key(rng, kind, keys)
+            text, doi = self.entry(rng, key, kind)
+            r = rng.random()
+            if doi and dois and r < 0.01: # same DOI as an earlier entry
+                text = text.replace(doi, rng.choice(dois))
+                doi = None
+            elif texts and r < 0.02: # lightly edited copy of an earlier entry
+                j = rng.randrange(len(texts))
+                text = texts[j].replace('{' + order[j] + ',', '{' + key + ',', 1).replace(' the ', ' a ', 1)
+            if doi:
+                dois.append(doi)
+            order.append(key)
+            texts.append(text)
+        with open(os.path.join(directory, 'auto_generated.bib'), 'w') as f:
+            f.write('\n'.join(texts))
+
+        cited = [key for key in order if rng.random() < 0.9]
+        rng.shuffle(cited)
+        lines = ['\\relax\n', '\\citation{REVTEX41Control}\n']
+        i = 0
+        while i < len(cited):
+            n = rng.randint(1, 4)
+            lines.append('\\citation{{{0}}}\n'.format(','.join(cited[i:i+n])))
+            if rng.random() < 0.05: # cited again later on
+                lines.append('\\citation{{{0}}}\n'.format(rng.choice(cited[:i+n])))
+            i += n
+        lines.extend('\\bibcite{{{0}}}{{{{{1}}}{{}}{{{{}}}}{{{{}}}}}}\n'.format(key, i + 1) for (i, key) in enumerate(cited))
+        with open(os.path.join(directory, tag + '_temp.aux'), 'w') as f:
+            f.writelines(lines)
+        return order
+
+    def generatePas(self, size, directory):
+        """ Write pasBib.bib with size PAS entries, in the format pas-bib.py itself writes
+
+        :param size: number of bib entries
+        :param directory: where to write the file
+        """
+        rng = random.Random('{0}:pas:{1}'.format(self._seed, size))
+        keys = set()
+        with open(os.path.join(directory, 'pasBib.bib'), 'w') as f:
+            f.write('BibFile generated by bibBench version {0}\n'.format(__version__))
+            for i in range(size):
+                key = self.key(rng, 'techreport', keys)
+                f.write('@ARTICLE{{{0},\n'
+                        '      COLLABORATION = {{CMS}},\n'
+                        '      TITLE       = "{1}",\n'
+                        '      AUTHOR      = "{{CMS Collaboration}}",\n'
+                        '      URL         = "http://cdsweb.cern.ch/record/{2}",\n'
+                        '      JOURNAL     = "CMS Physics Analysis Summary",\n'
+                        '      VOLUME      =  "{0}",\n'
+                        '      YEAR        = "20{3}"\n'
+                        '}}\n'.format(key, ' '.join(self.title(rng).split()), rng.randint(10**6, 3 * 10**6), key[12:14]))
+
+
+def measure(phases, repeat):
+    """ Run a sequence of dependent phases, timing each, then once more under tracemalloc for the peak memory
+
+    :param phases: function returning a fresh list of (name, callable) for one run: later phases may use the state
+                   left by earlier ones
+    :param repeat: number of timed runs: the fastest time of each phase is kept
+    :return: {phase: {'time': seconds, 'peak': bytes}}
+    """
+    result = {}
+    for i in range(repeat):
+        for (name, phase) in phases():
+            start = time.perf_counter()
+            phase()
+            elapsed = time.perf_counter() - start
+            if name not in result or elapsed < result[name]['time']:
+                result[name] = {'time': elapsed}
+    # memory is measured separately: tracing slows everything down several times over
+    tracemalloc.start()
+    try:
+        for (name, phase) in phases():
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # before Python 3.9: a restart resets the peak, and the phase's allocations are still all traced
+                tracemalloc.stop()
+                tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+            phase()
+            result[name]['peak'] = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def benchCleanRefs(source, work):
+    """ The phases of a cleanRefs run on the corpus in source. Each run works on a fresh copy, as rewrite changes the bib file.
+
+    :param source: directory holding the generated bib and aux files
+    :param work: scratch directory for the copy
+    """
+    def phases():
+        if os.path.exists(work):
+            shutil.rmtree(work)
+        shutil.copytree(source, work)
+        refs = cleanRefs.cleanRefs(_tag, work, 0, False, quiet=True)
+
+        def duplicates():
+            # a fresh index, on its own: checkRefs has already built and used one
+            refs._dupIndex = None
+            index = refs.duplicateIndex()
+            for field in index.exactFields:
+                index.exact(field, refs._refs)
+            index.near(refs._refs)
+
+        return [('aux', refs.getRefList), ('parse', refs.getRefs), ('check', refs.checkRefs),
+                ('duplicates', duplicates), ('rewrite', refs.rewrite)]
+    return phases
+
+
+# run under the Python 2 interpreter: times the pas-bib.py phases on pasBib.bib in the current directory
+_pasDriver = r"""
+import collections, imp, json, os, resource, sys, time
+try:
+    pas = imp.load_source('pasbib', sys.argv[1])
+except ImportError as e:
+    print(json.dumps({'skipped': str(e)}))
+    sys.exit(0)
+pas.version = 'bibBench'
+result = collections.OrderedDict()
+base = os.getcwd()
+for i in range(int(sys.argv[2])):
+    docs = pas.DocList(0, None, 'notes', False)
+    # generateBib writes pasBib.bib in the current directory: keep the input intact
+    for (name, phase, where) in (('getDocInfoFromBib', docs.getDocInfoFromBib, base), ('generateBib', docs.generateBib, os.path.join(base, 'out'))):
+        os.chdir(where)
+        start = time.time()
+        phase()
+        elapsed = time.time() - start
+        if name not in result or elapsed < result[name]['time']:
+            result[name] = {'time': elapsed}
+        result[name]['peak'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+print(json.dumps(result))
+"""
+
+
+def benchPasBib(python2, directory, repeat):
+    """ Time the pas-bib.py phases on the pasBib.bib in directory. The peak is the maximum RSS of the interpreter so far,
+        as Python 2 has no tracemalloc.
+
+    :param python2: the Python 2 interpreter, or None
+    :param directory: directory holding pasBib.bib
+    :param repeat: number of timed runs
+    :return: {phase: {'time': seconds, 'peak': bytes}}, or {'skipped': reason}
+    """
+    if not python2:
+        return {'skipped': 'no Python 2 interpreter'}
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pas-bib.py')
+    os.makedirs(os.path.join(directory, 'out'), exist_ok=True)
+    try:
+        proc = subprocess.run([python2, '-c', _pasDriver, script, str(repeat)], cwd=directory,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    except OSError as e:
+        return {'skipped': str(e)}
+    if proc.returncode != 0:
+        return {'skipped': (proc.stderr.strip().splitlines() or ['exit status {0}'.format(proc.returncode)])[-1]}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold, minTime):
+    """ Compare results to a baseline results file
+
+    :param results: the results of this run
+    :param baseline: the results of the reference run
+    :param threshold: allowed fractional increase of time and peak memory
+    :param minTime: phases faster than this (seconds) in both runs are too noisy to compare
+    :return: list of (tool, size, phase, metric, old, new) beyond the threshold; metrics that are 0 in the baseline are
+             not compared, as they have no fractional increase
+    """
+    regressions = []
+    for (tool, sizes) in sorted(results['results'].items()):
+        for (size, phases) in sorted(sizes.items(), key=lambda s: int(s[0])):
+            old = baseline.get('results', {}).get(tool, {}).get(size, {})
+            if 'skipped' in phases or 'skipped' in old:
+                continue
+            for (phase, metrics) in phases.items():
+                if phase not in old:
+                    continue
+                if max(metrics['time'], old[phase]['time']) < minTime:
+                    continue
+                for metric in ('time', 'peak'):
+                    if metric in metrics and old[phase].get(metric) and metrics[metric] > old[phase][metric] * (1 + threshold):
+                        regressions.append((tool, size, phase, metric, old[phase][metric], metrics[metric]))
+    return regressions
+
+
+def gitRevision(directory):
+    """ The commit checked out in directory, if it is a git work tree """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=directory, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def findPython2():
+    """ The first working Python 2 interpreter on the path, or None """
+    for name in ('python2', 'python2.7'):
+        path = shutil.which(name)
+        if path and subprocess.call([path, '-c', 'pass'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+            return path
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cleanRefs.py and pas-bib.py on synthetic bib files.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=list(_sizes), help='corpus sizes, in bib entries [%(default)s]')
+    parser.add_argument('--seed', type=int, default=2023, help='seed of the corpus generator [%(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='timed runs per phase; the fastest is kept [%(default)s]')
+    parser.add_argument('-o', '--output', default='bibBench.json', help='results file [%(default)s]')
+    parser.add_argument('-c', '--compare', metavar='BASELINE', help='results file of a previous run, to check for regressions')
+    parser.add_argument('-t', '--threshold', type=float, default=0.25, help='allowed fractional increase of time or memory over the baseline [%(default)s]')
+    parser.add_argument('--min-time', type=float, default=0.01, help='do not compare phases faster than this, in seconds [%(default)s]')
+    parser.add_argument('--python2', help='Python 2 interpreter for pas-bib.py [first python2 on the path]')
+    parser.add_argument('--work-dir', help='keep the generated corpora here, rather than in a temporary directory')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the timings as they are made')
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    python2 = args.python2 or findPython2()
+    work = args.work_dir or tempfile.mkdtemp(prefix='bibBench-')
+    generator = corpus(args.seed)
+    results = {'meta': {'version': __version__, 'seed': args.seed, 'repeat': args.repeat,
+                        'python': platform.python_version(), 'platform': platform.platform(),
+                        'commit': gitRevision(os.path.dirname(os.path.abspath(__file__))),
+                        'date': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')},
+               'results': {'cleanRefs': {}, 'pas-bib': {}}}
+    try:
+        for size in args.sizes:
+            source = os.path.join(work, str(size))
+            os.makedirs(source, exist_ok=True)
+            generator.generate(size, source)
+            results['results']['cleanRefs'][str(size)] = measure(benchCleanRefs(source, os.path.join(work, 'run')), args.repeat)
+            generator.generatePas(size, source)
+            results['results']['pas-bib'][str(size)] = benchPasBib(python2, source, args.repeat)
+            if args.verbose:
+                for (tool, sizes) in sorted(results['results'].items()):
+                    print('{0} {1}: {2}'.format(tool, size, json.dumps(sizes[str(size)], sort_keys=True)))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print('{0:10} {1:>8} {2:18} {3:>10} {4:>12}'.format('tool', 'entries', 'phase', 'time (s)', 'peak (MB)'))
+    for (tool, sizes) in sorted(results['results'].items()):
+        for (size, phases) in sorted(sizes.items(), key=lambda s: int(s[0])):
+            if 'skipped' in phases:
+                print('{0:10} {1:>8} skipped: {2}'.format(tool, size, phases['skipped']))
+                continue
+            for (phase, metrics) in phases.items():
+                print('{0:10} {1:>8} {2:18} {3:10.3f} {4:12.1f}'.format(tool, size, phase, metrics['time'], metrics.get('peak', 0) / 2.**20))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_time)
+        for (tool, size, phase, metric, old, new) in regressions:
+            print('REGRESSION {0} {1} {2} {3}: {4:.4g} -> {5:.4g} (+{6:.0%})'.format(tool, size, phase, metric, old, new, new / old - 1))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against {0} (threshold {1:.0%})'.format(args.compare, args.threshold))
+
+
+if __name__ == '__main__':
+    main()
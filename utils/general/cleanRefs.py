@@ -5,6 +5,7 @@
 from __future__ import print_function
 
 __version__ = "2.9"
+__parserVersion__ = "2" # bump whenever the parsed _bib contents change, to invalidate cached parses
 
 
 
@@ -17,6 +18,17 @@ import io
 import string
 import subprocess
 import collections
+import zlib
+import bisect
+import json
+import hashlib
+import locale
+import marshal
+import mmap
+import tempfile
+import time
+import glob
+import multiprocessing
 
 
     
@@ -39,39 +51,680 @@ def f5(seq, idfun=None):
        result.append(item)
     return result
 
+_delims = {"{":"}", '"':'"', "<":">"} # matching closing delims
+_delimScan = dict((d, re.compile(re.escape('\\'+d)+'|'+re.escape('\\'+c)+'|['+re.escape(d+c)+']')) for d, c in _delims.items()) # escaped open/close delims, or bare delims
+_bibHead = re.compile(r'\s*@(\S*)\s*\{') # bib entry starting exactly at the scan position
+_bibParse = re.compile(r'^\s*@(\S*)\s*\{',re.MULTILINE) # look for an entire bib entry
+_tagParse = re.compile(r'\s*(\S*)\s*,') # find the bib tag at the start of the body
+_fieldParse = re.compile(r'\s*(\S*)\s*=\s*(\S)') # need to protect against "=" inside a URL.
+_trim = re.compile(r'\s{2,}|\n') # what about \r
+_newlines = re.compile(r'\r\n?') # universal newlines, as for text-mode reads
+_textLineEnds = re.compile(u'\n') # line ends of decoded text
+_rawLineEnds = re.compile(b'\r\n|\r|\n') # line ends of the raw bytes it was read from
+_highBytes = re.compile(b'[\x80-\xFF]+') # runs of non-ASCII bytes
+_rawBibKey = re.compile(br'^[ \t]*@[^{\s]*\s*\{\s*([^,\s]*)', re.MULTILINE) # entry starts in the raw bytes, with their keys
+
+def scanBalanced(text, pin, delim, endpos=None):
+    """ Find the end of a delimited section of text, working on absolute offsets instead of copies.
+        Same rules as extractBalanced: escaped delimiters are skipped.
+
+        :param text: text to search
+        :param pin: offset just past the opening delimiter
+        :param delim: opening delimiter, one of '{', '"', and  '<'
+        :param endpos: optional offset at which to stop looking
+        :return: offset just past the closing delimiter, or None if it is not found"""
+    close = _delims[delim]
+    nbraces = 1
+    if endpos is None:
+        endpos = len(text)
+    for m in _delimScan[delim].finditer(text, pin, endpos):
+        c = m.group(0)
+        if len(c) > 1: # escaped delim
+            continue
+        if c == close:
+            nbraces -= 1
+            if nbraces == 0:
+                return m.end(0)
+        else:
+            nbraces += 1
+    return None
+
 def extractBalanced(text, delim):
     """ Extract a delimited section of text: 
         Does not check for escaped delimeters. 
 
         :param text: text to search
         :param delim: delimiter to match. Available opening delimiters are '{', '"', and  '<'."""
-    delims = {"{":"}", '"':'"', "<":">"} # matching closing delims
-    if not(delim in delims.keys()):
+    if not(delim in _delims.keys()):
         pout = text.find(',')+1
         pin = 0
     else:
         pin = text.find(delim) + 1
         if pin == 0: 
             print('Bad delim')
-        nbraces = 1
-        pout = pin
-        while nbraces > 0:
-            if pout > len(text): 
-                print("extractBalanced >>> Error parsing text: {0}".format(text[pin:pin+min([len(text),15])]))
-                return [0, None] # probably unmatched } inside TeX comment string
-            if text[pout:pout+2] == '\\'+delim: # look for escaped delim
-                pout += 2
-            else:
-                if text[pout:pout+2] == '\\'+delims[delim]:
-                    pout += 2
-                else:
-                    if text[pout:pout+1] == delims[delim]:
-                        nbraces -= 1
-                    elif text[pout:pout+1] == delim:
-                        nbraces += 1
-                    pout += 1
+        pout = scanBalanced(text, pin, delim)
+        if pout is None:
+            print("extractBalanced >>> Error parsing text: {0}".format(text[pin:pin+min([len(text),15])]))
+            return [0, None] # probably unmatched } inside TeX comment string
     return [pout, text[pin:pout-1]]
 
+def parseFields(text, start, end):
+    """ Extract the fields of a citation body lying between two offsets of the bib text
+
+        :param text: the bib text
+        :param start: offset of the first field (just past the bib tag)
+        :param end: offset of the closing brace of the entry
+        :return: dictionary of {fieldName:fieldValue}"""
+    entry = {}
+    p = start
+    m = _fieldParse.search(text, p, end)
+    while m:
+        field = m.group(1).upper()
+        delim = m.group(2)
+        pin = m.end(0) - 1
+        if delim in _delims:
+            pin += 1
+            pout = scanBalanced(text, pin, delim, end)
+            if pout is None:
+                raise cleanError("extractBalanced >>> Error parsing text: {0}".format(text[pin:pin+15]))
+            p, vout = pout, pout - 1
+        else: # bare value, terminated by a comma
+            pout = text.find(',', pin, end)
+            if pout < 0:
+                p, vout = pin, end - 1 # as for extractBalanced: last character dropped
+            else:
+                p, vout = pout + 1, pout
+        entry[field] = _trim.sub(' ', text[pin:vout])
+        m = _fieldParse.search(text, p, end)
+    return entry
+
+def replaceFile(src, dst):
+    """ Move src over dst atomically, as os.replace, which python 2 lacks
+
+    :param src: file name of the new content
+    :param dst: file name to replace
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst): # rename does not overwrite on windows
+            os.remove(dst)
+        os.rename(src, dst)
+
+def lineStarts(buf):
+    """ Index of the offsets at which each line starts, for use with bisect
+
+        :param buf: decoded text (lines end with newline) or raw bytes (lines end with any of CRLF, CR and LF)"""
+    lineEnds = _rawLineEnds if isinstance(buf, bytes) else _textLineEnds # bytes is str on python 2, text is unicode
+    return [0] + [m.end(0) for m in lineEnds.finditer(buf)]
+
+def byteOffsets(text, raw, encoding, offsets):
+    """ Map offsets in decoded text to offsets in the raw bytes it was decoded (with universal newlines) from
+
+        :param text: the decoded text
+        :param raw: the raw bytes
+        :param encoding: the encoding used to decode raw
+        :param offsets: sorted list of offsets into text
+        :return: list of the matching offsets into raw"""
+    if len(text) == len(raw): # single-byte characters, no CRLF: nothing moved
+        return list(offsets)
+    textLines = lineStarts(text)
+    rawLines = lineStarts(raw)
+    result = []
+    for c in offsets:
+        k = bisect.bisect_right(textLines, c) - 1
+        result.append(rawLines[k] + len(text[textLines[k]:c].encode(encoding)))
+    return result
+
+def nonAsciiRuns(raw):
+    """ Find every run of non-ASCII bytes in a raw bib file, in a single pass
+
+        :param raw: the raw bytes of the bib file
+        :return: generator of (offset, line, column, key, run): line and column count from 1, key is that of the entry
+                 the run is in (None before the first entry)"""
+    lines = lineStarts(raw)
+    entries = [(m.start(0), m.group(1)) for m in _rawBibKey.finditer(raw)]
+    starts = [e[0] for e in entries]
+    for m in _highBytes.finditer(raw):
+        p = m.start(0)
+        k = bisect.bisect_right(lines, p) - 1
+        e = bisect.bisect_right(starts, p) - 1
+        yield (p, k + 1, p - lines[k] + 1, entries[e][1].decode('ascii', 'replace') if e >= 0 else None, m.group(0))
+
+def tokenizeBib(text):
+    """ Scan a bib database once, lazily yielding the entries in file order. @COMMENT entries are skipped.
+
+        :param text: the full text of the bib file
+        :return: generator of (artType, key, fields, span), where span is the (start, end) offset of the entry from '@' to its closing brace"""
+    p = 0
+    # _bibHead covers an entry starting right at p; _bibParse the following lines
+    m = _bibHead.match(text, p) or _bibParse.search(text, p)
+    while m:
+        artType = m.group(1).upper()
+        pin = m.end(0)
+        pout = scanBalanced(text, pin, '{')
+        if pout is None:
+            raise cleanError("extractBalanced >>> Error parsing text: {0}".format(text[pin:pin+15]))
+        if (artType != u'COMMENT'):
+            t = _tagParse.match(text, pin, pout - 1)
+            if (t):
+                yield (artType, t.group(1), parseFields(text, t.end(0), pout - 1), (m.start(1) - 1, pout))
+            else:
+                body = text[pin:pout-1].strip()
+                raise cleanError("WARNING: Could not find a tag in string starting with: {0}".format(body[0:min([len(body), 25])])) 
+        p = pout
+        m = _bibHead.match(text, p) or _bibParse.search(text, p)
+
+_globalFlags = re.compile(r'^\(\?[aiLmsux]+\)') # leading inline flags, not allowed inside a combined pattern
+_groupRefs = re.compile(r'\\[1-9]|\(\?P[<=]') # backreferences would be renumbered, and group names clash, in a combined pattern
+
+class ruleEngine(object):
+    """ Field-dispatched checks of bib entries. Each field's rules are combined into one alternation, which screens out clean values
+        in a single search, and one pattern of per-rule look-aheads, each still scanning the value, that names the rules a flagged
+        value breaks. Ad hoc checks are visitors, callables (key, artType, fields) returning messages.
+    """
+
+    def __init__(self, rules=()):
+        """
+        :param rules: list of (field, compiled re, message, severity)
+        """
+        self._rules = []
+        self._typeVisitors = {} # visitors restricted to one artType
+        self._visitors = []
+        self.addRules(rules)
+
+    def addRules(self, rules):
+        """ Add rules and recompile the dispatch tables
+
+        :param rules: list of (field, compiled re, message, severity)
+        """
+        self._rules.extend(rules)
+        self.compile()
+
+    def loadRules(self, filename):
+        """ Add rules from a JSON data file, a list of objects with keys field, pattern, message and (optionally) severity
+
+        :param filename: name of the rules file
+        :return: the new rules
+        """
+        with io.open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        rules = [(r['field'].upper(), re.compile(r['pattern']), r['message'], r.get('severity', 'Warning')) for r in data]
+        self.addRules(rules)
+        return rules
+
+    def addVisitor(self, visitor, artType=None):
+        """ Add an ad hoc check. Visitors for a specific artType run before the general ones.
+
+        :param visitor: callable (key, artType, fields) returning an iterable of messages
+        :param artType: only visit entries of this type, e.g. ARTICLE
+        """
+        if artType:
+            self._typeVisitors.setdefault(artType, []).append(visitor)
+        else:
+            self._visitors.append(visitor)
+
+    def compile(self):
+        """ Build the per-field dispatch table: field -> (alternation, combined pattern, [(group name, rule index)]), plus a list of
+            (field, rule index) for the rules that cannot be combined"""
+        fields = collections.OrderedDict()
+        self._single = []
+        for (i, rule) in enumerate(self._rules):
+            src = rule[1].pattern
+            if _groupRefs.search(src):
+                self._single.append((rule[0], i))
+                continue
+            flags = ''.join(c for (c, flag) in (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE)) if rule[1].flags & flag)
+            src = _globalFlags.sub('', src)
+            if flags:
+                src = '(?' + flags + ':' + src + ')'
+            fields.setdefault(rule[0], []).append(('r{0}'.format(i), i, src))
+        self._dispatch = {}
+        for (field, rules) in fields.items():
+            alternation = '|'.join('(?:{0})'.format(src) for (name, i, src) in rules)
+            combined = ''.join(r'(?:(?=[\s\S]*?(?P<{0}>{1})))?'.format(name, src) for (name, i, src) in rules)
+            try:
+                self._dispatch[field] = (re.compile(alternation), re.compile(combined), [(name, i) for (name, i, src) in rules])
+            except re.error: # e.g. scoped flags before python 3.6, or too many groups
+                self._single.extend((field, i) for (name, i, src) in rules)
+
+    def check(self, key, artType, fields):
+        """ Run the rules and visitors over one bib entry
+
+        :param key: bib key
+        :param artType: entry type, e.g. ARTICLE
+        :param fields: dictionary of {fieldName:fieldValue}
+        :return: list of (check, message): rule messages in rule order, checked under the field name, followed by the visitor
+                 messages, checked under the visitor name
+        """
+        hits = []
+        for (fieldName, value) in fields.items():
+            table = self._dispatch.get(fieldName)
+            if table and table[0].search(value):
+                m = table[1].match(value)
+                hits.extend(i for (name, i) in table[2] if m.start(name) >= 0)
+        for (fieldName, i) in self._single:
+            if fieldName in fields and self._rules[i][1].search(fields[fieldName]):
+                hits.append(i)
+        hits.sort()
+        messages = [(self._rules[i][0], "{0}:\t {1} {3}: {2}.".format(key, self._rules[i][0], self._rules[i][2], self._rules[i][3])) for i in hits]
+        for visitor in self._typeVisitors.get(artType, []) + self._visitors:
+            messages.extend((visitor.__name__, msg) for msg in visitor(key, artType, fields))
+        return messages
+
+_noCollab = re.compile('Collaboration') # to check for a Collaboration as author: not _generally_ okay for papers
+_jhepVolume = re.compile('^[0-9]{2}$')
+_blankCheck = re.compile(r'^\s+$')
+
+def checkTechreport(key, artType, fields):
+    """ ad hoc check of TECHREPORT entries """
+    # Some techreports have DOIs, so it's OK for them to not have a URL in that case
+    if not 'URL' in fields and not 'DOI' in fields:
+        yield '{0}:\t Missing URL for Techreport '.format(key)
+
+def checkArticle(key, artType, fields):
+    """ ad hoc check of ARTICLE entries """
+    if not 'AUTHOR' in fields:
+        yield '{0}:\t Missing AUTHOR '.format(key)
+    else:
+        if _noCollab.search(fields['AUTHOR']):
+            yield "{0}:\t {1} listed as author. Please check this is correct.".format(key, fields['AUTHOR'])
+    if not 'DOI' in fields:
+        yield '{0}:\t Missing DOI '.format(key)
+    if not 'EPRINT' in fields:
+        yield '{0}:\t Missing EPRINT '.format(key)
+    if not 'JOURNAL' in fields:
+        yield '{0}:\t Missing JOURNAL. Reformat as UNPUBLISHED?'.format(key)
+    else:
+    ## check for wrong number of digits in JHEP volume: must be two
+        if (fields['JOURNAL']==u'JHEP' or fields['JOURNAL']==u'J. High Energy Phys.') and not _jhepVolume.match(fields['VOLUME']):
+            yield '{0}:\t JHEP volume number given as {1}: should always be exactly two digits (0 left padded).'.format(key,fields['VOLUME'])
+
+def checkAuthorCount(key, artType, fields):
+    """ number of authors check """
+    if 'AUTHOR' in fields:
+        etal = ' and others' in fields['AUTHOR']
+        nauthors = fields['AUTHOR'].count(' and ') + 1
+        if etal:
+            nauthors = nauthors - 1
+        collab = 'COLLABORATION' in fields
+        # here's the actual test 
+        if (nauthors > 1) and etal and collab:
+            yield '{0}:\t Author count. More authors than necessary for a paper with a collaboration. List only the first plus "and others".'.format(key)
+        if (nauthors > 1 and nauthors < 15) and etal and not(collab):
+            yield '{0}:\t Author count. Incomplete author list. Include all authors for lists as long as 15'.format(key)
+        if (nauthors > 15) and ~collab:
+            yield '{0}:\t Author count. More authors than necessary. Include only the first author plus "and others" for lists longer than 15.'.format(key)
+        if (nauthors==1) and etal and not(collab):
+            yield '{0}:\t Author count query. Are there really more than 15 authors for this reference?'.format(key)
+
+def checkDoiAndUrl(key, artType, fields):
+    """ check for both url and doi """
+    if 'DOI' in fields and 'URL' in fields:
+        yield '{0}:\t Both DOI and URL. DOI only is preferred.'.format(key)
+
+def checkBlankFields(key, artType, fields):
+    """ empty/blank field check """
+    for item in fields.items():
+        if not item[1]:
+            yield '{1}: Empty value for field {0}'.format(item[0],key)
+        if _blankCheck.search(item[1]):
+            yield '{1}: Blank value for field {0}'.format(item[0],key)
+
+_cdsRecord = re.compile(r'(?:record/|recid(?:=|%3D)|cds\.cern\.ch/)(\d+)', re.IGNORECASE) # CDS record ID in a URL: .../record/NNN, ...?recid=NNN or cds.cern.ch/NNN
+
+class requiredRefs(object):
+    """ Registry of the references every document must cite: JSON keyed by era, then document type ("*" for any), listing objects
+        with keys name, message and doi and/or cds (CDS record ID). Checked against sets of the cited DOIs and CDS record IDs.
+    """
+
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'requiredRefs.json')
+
+    def __init__(self, refs=()):
+        """
+        :param refs: list of required references, dictionaries with keys name, message, doi and/or cds
+        """
+        self.refs = list(refs)
+
+    @classmethod
+    def load(cls, filename=None, era=None, docType=None):
+        """ Read the required references for one era and document type from a registry file
+
+        :param filename: name of the JSON registry (default: the one shipped with this script)
+        :param era: analysis era, e.g. Run2; only the "*" entries if None
+        :param docType: document type, e.g. paper or pas; only the "*" entries if None
+        :return: requiredRefs, in file order, without repeats
+        """
+        with io.open(filename or cls.default, 'r', encoding='utf-8') as f:
+            data = json.load(f, object_pairs_hook=collections.OrderedDict)
+        refs = []
+        names = set()
+        for (eraKey, types) in data.items():
+            if eraKey not in ('*', era):
+                continue
+            for (typeKey, entries) in types.items():
+                if typeKey not in ('*', docType):
+                    continue
+                for ref in entries:
+                    if ref['name'] not in names:
+                        names.add(ref['name'])
+                        refs.append(ref)
+        return cls(refs)
+
+    @staticmethod
+    def citedIdentifiers(bib, keys):
+        """ Index the DOIs and CDS record IDs of the cited entries, in one pass
+
+        :param bib: dictionary of bibkey: (artType, {fieldName:fieldValue})
+        :param keys: the cited bib keys
+        :return: (set of DOIs, set of CDS record IDs)
+        """
+        dois = set()
+        records = set()
+        for key in keys:
+            if key in bib:
+                fields = bib[key][1]
+                if 'DOI' in fields:
+                    dois.add(fields['DOI'])
+                if 'URL' in fields:
+                    records.update(_cdsRecord.findall(fields['URL']))
+        return (dois, records)
+
+    def missing(self, bib, keys):
+        """ The required references not cited
+
+        :param bib: dictionary of bibkey: (artType, {fieldName:fieldValue})
+        :param keys: the cited bib keys
+        :return: list of the missing references, in registry order
+        """
+        (dois, records) = requiredRefs.citedIdentifiers(bib, keys)
+        return [ref for ref in self.refs if not (ref.get('doi') in dois or ref.get('cds') in records)]
+
+class bibCache(object):
+    """ Persistent cache of parsed bib databases, keyed by the content hash of the bib file and the parser version: marshal files,
+        read through a memory map, least recently used evicted first.
+    """
+
+    suffix = '.bibc'
+
+    def __init__(self, cacheDir, maxSize=256):
+        """
+        :param cacheDir: directory holding the cache files, created if needed
+        :param maxSize: size limit of the cache in MB
+        """
+        self._cacheDir = cacheDir
+        self._maxSize = maxSize * 1024 * 1024
+        if not os.path.isdir(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError:
+                if not os.path.isdir(cacheDir): # created meanwhile by another worker is fine
+                    raise
+
+    @staticmethod
+    def key(raw):
+        """ Cache key for the contents of a bib file, as decoded with the preferred encoding
+
+        :param raw: bib file contents (bytes)
+        """
+        h = hashlib.sha256(raw)
+        h.update('{0}/{1}/{2}/{3}'.format(__parserVersion__, marshal.version, sys.version_info[:2], locale.getpreferredencoding(False)).encode('ascii', 'replace'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self._cacheDir, key + bibCache.suffix)
+
+    def load(self, key):
+        """ Fetch a cached parse, or None on a miss. A hit marks the entry as recently used.
+
+        :param key: cache key from bibCache.key
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with io.open(path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    parsed = marshal.loads(mm)
+                finally:
+                    mm.close()
+            os.utime(path, None)
+        except (ValueError, EOFError, TypeError, OSError):
+            print('>> Discarding unreadable cache entry {0}'.format(path))
+            try:
+                os.remove(path)
+            except OSError:
+                pass # already removed by another process sharing the cache
+            return None
+        return parsed
+
+    def store(self, key, parsed):
+        """ Add a parse to the cache, replacing the file atomically, then evict old entries
+
+        :param key: cache key from bibCache.key
+        :param parsed: (_bib, _spans, duplicates, encoding)
+        """
+        (fd, tmp) = tempfile.mkstemp(dir=self._cacheDir, suffix='.tmp')
+        with io.open(fd, 'wb') as f:
+            marshal.dump(parsed, f)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o644 & ~umask) # mkstemp creates private files, the cache may be shared
+        replaceFile(tmp, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in its size limit. The newest entry is always kept. """
+        entries = []
+        for name in os.listdir(self._cacheDir):
+            if name.endswith(bibCache.suffix):
+                try:
+                    st = os.stat(os.path.join(self._cacheDir, name))
+                except OSError:
+                    continue # evicted meanwhile by another process sharing the cache
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for (mtime, size, name) in sorted(entries)[:-1]:
+            if total <= self._maxSize:
+                break
+            try:
+                os.remove(os.path.join(self._cacheDir, name))
+            except OSError:
+                pass
+            total -= size
+
+_parseMemo = None # per-process memo of marshalled parses, keyed as for bibCache: set up in batch workers only
+_parseMemoSize = 8 # most recently used parses kept in the memo
+
+_texMarkup = re.compile(r'\\[a-zA-Z]+|[{}$\\]') # TeX commands and grouping, dropped from titles and names
+_nonWord = re.compile(r'[^0-9a-z]+')
+_urlParse = re.compile(r'^\s*(?:https?://)?(?:www\.)?([^/?#]*)([^#]*?)/*(?:#.*)?\s*$', re.IGNORECASE)
+
+def normalizeUrl(url):
+    """ Normalized URL for duplicate matching: no scheme, www. prefix, fragment or trailing slash; lower case host """
+    m = _urlParse.match(url)
+    if not m:
+        return url.strip()
+    return m.group(1).lower().replace('cdsweb.cern.ch', 'cds.cern.ch') + m.group(2)
+
+def normalizeText(text):
+    """ Lower case alphanumeric words of a (TeX) title or name, separated by single spaces """
+    return _nonWord.sub(' ', _texMarkup.sub('', text).lower()).strip()
+
+def firstAuthor(author):
+    """ Normalized surname of the first author in a BibTeX author list """
+    first = author.split(' and ')[0]
+    if ',' in first:
+        return normalizeText(first.split(',')[0])
+    words = normalizeText(first).split()
+    return words[-1] if words else ''
+
+class duplicateIndex(object):
+    """ Index of the entries of a bib database for duplicate detection: hash maps on DOI, EPRINT and normalized URL for exact
+        duplicates, banded MinHash signatures of title and first author for near duplicates, e.g. a preprint and its article.
+    """
+
+    exactFields = ('DOI', 'EPRINT', 'URL')
+
+    def __init__(self, bib, nbins=64, bands=8, threshold=0.8):
+        """
+        :param bib: dictionary of bibkey: (artType, {fieldName:fieldValue})
+        :param nbins: length of the MinHash signatures
+        :param bands: number of LSH bands, each of nbins/bands rows
+        :param threshold: minimum Jaccard similarity of the title shingles for a near duplicate
+        """
+        self._bib = bib
+        self._threshold = threshold
+        self._exact = dict((field, collections.OrderedDict()) for field in duplicateIndex.exactFields)
+        self._shingles = {}
+        self._authors = {}
+        self._ids = {} # exact-match identifiers of the entries with a title
+        buckets = {}
+        rows = nbins // bands
+        for (key, (artType, fields)) in bib.items():
+            ids = tuple(self.identifier(key, field) for field in duplicateIndex.exactFields)
+            for (field, value) in zip(duplicateIndex.exactFields, ids):
+                if value is not None:
+                    self._exact[field].setdefault(value, []).append(key)
+            title = normalizeText(fields.get('TITLE', ''))
+            if len(title) < 3:
+                continue
+            self._ids[key] = ids
+            self._authors[key] = firstAuthor(fields.get('AUTHOR', ''))
+            shingles = set(title[i:i+3] for i in range(len(title) - 2))
+            shingles.add('@' + self._authors[key])
+            self._shingles[key] = shingles
+            sig = duplicateIndex.signature(shingles, nbins)
+            for b in range(bands):
+                buckets.setdefault((b,) + tuple(sig[b*rows:(b+1)*rows]), []).append(key)
+        self._candidates = set()
+        for members in buckets.values():
+            for i in range(1, len(members)):
+                for j in range(i):
+                    self._candidates.add((members[j], members[i]))
+
+    @staticmethod
+    def signature(shingles, nbins):
+        """ One-permutation MinHash: each shingle is hashed once into one of nbins bins, keeping the minimum per bin.
+            Empty bins borrow from the next filled bin (rotation densification). """
+        empty = 1 << 32
+        sig = [empty] * nbins
+        for sh in shingles:
+            h = zlib.crc32(sh.encode('utf-8')) & 0xffffffff
+            (v, b) = divmod(h, nbins)
+            if v < sig[b]:
+                sig[b] = v
+        for i in range(nbins):
+            j = i
+            while sig[j % nbins] == empty and j < i + nbins:
+                j += 1
+            if sig[i] == empty and j < i + nbins:
+                sig[i] = sig[j % nbins] + (j - i) * (empty // nbins)
+        return sig
+
+    def identifier(self, key, field):
+        """ Value of an exact-match field of an entry, as indexed, or None """
+        fields = self._bib[key][1]
+        if not field in fields:
+            return None
+        return normalizeUrl(fields[field]) if field == 'URL' else fields[field]
+
+    def exact(self, field, keys=None):
+        """ Exact duplicates on one field
+
+        :param field: DOI, EPRINT or URL (normalized)
+        :param keys: optional set of bib keys to restrict to, e.g. the cited ones
+        :return: ordered dictionary of value: [bib keys], for values shared by more than one entry, in bib file order
+        """
+        dupes = collections.OrderedDict()
+        for (value, members) in self._exact[field].items():
+            if keys is not None:
+                members = [k for k in members if k in keys]
+            if len(members) > 1:
+                dupes[value] = members
+        return dupes
+
+    def near(self, keys=None):
+        """ Near duplicates: entries with similar titles and the same first author that are not exact duplicates and do not
+            have different DOIs, EPRINTs or URLs (which would make them distinct documents)
+
+        :param keys: optional set of bib keys to restrict to, e.g. the cited ones
+        :return: list of (bibkey, bibkey, title similarity), in bib file order
+        """
+        order = dict((k, i) for (i, k) in enumerate(self._bib))
+        pairs = []
+        for (a, b) in self._candidates:
+            if keys is not None and not (a in keys and b in keys):
+                continue
+            if self._authors[a] != self._authors[b]:
+                continue
+            if any(ia is not None and ib is not None for (ia, ib) in zip(self._ids[a], self._ids[b])):
+                continue # distinct documents, or an exact duplicate already
+            similarity = len(self._shingles[a] & self._shingles[b]) / float(len(self._shingles[a] | self._shingles[b]))
+            if similarity >= self._threshold:
+                pairs.append((a, b, similarity) if order[a] < order[b] else (b, a, similarity))
+        return sorted(pairs, key=lambda p: (order[p[0]], order[p[1]]))
+
+_auxParse = re.compile(br'^\\(?:citation\{([^}\n]*)\}|bibcite\{([^}\n]*)\}\{\{([^}\n]*)\}|@input\{([^}\n]*)\})', re.MULTILINE)
+
+class auxIndex(object):
+    r""" Ordered, de-duplicated citation keys of a document, from one regex pass over each memory-mapped aux file, following
+        \@input lines where they appear: \citation keys first, then those only in \bibcite lines.
+    """
+
+    badrefs = ('REVTEX41Control', 'apsrev41Control') # control entries written by REVTeX
+
+    def __init__(self, baseDir):
+        r"""
+        :param baseDir: directory of the build, against which \@input file names are resolved
+        """
+        self._baseDir = baseDir
+        self.keys = [] # citation keys, ordered
+        self.counts = collections.Counter() # number of \citation lines naming each key
+        self.labels = collections.OrderedDict() # \bibcite label of each key, in bibliography order
+        self.files = [] # aux files read
+        self._seen = set()
+
+    def scan(self, name):
+        """ Add the citations of an aux file, and of the aux files it inputs
+
+        :param name: aux file name, relative to baseDir
+        """
+        self._scan(os.path.join(self._baseDir, name))
+        for key in self.labels:
+            if not key in self._seen:
+                self._seen.add(key)
+                self.keys.append(key)
+        return self
+
+    def _scan(self, file):
+        if file in self.files or not os.path.exists(file): # \@input ignores missing files
+            return
+        self.files.append(file)
+        with io.open(file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for m in _auxParse.finditer(mm):
+                    if m.group(1) is not None:
+                        newrefs = m.group(1).decode('utf-8').split(',')
+                        if not (newrefs[0] in auxIndex.badrefs):
+                            self.counts.update(newrefs)
+                            for key in newrefs:
+                                if not key in self._seen:
+                                    self._seen.add(key)
+                                    self.keys.append(key)
+                    elif m.group(2) is not None:
+                        self.labels[m.group(2).decode('utf-8')] = m.group(3).decode('utf-8')
+                    else:
+                        self._scan(os.path.join(self._baseDir, m.group(4).decode('utf-8')))
+            finally:
+                mm.close()
+
+finding = collections.namedtuple('finding', ['tag', 'key', 'check', 'message']) # one problem found in a document: key is None for document-wide checks
+
 class cleanError(Exception):
     """Base class for exceptions in this module.
     """
@@ -79,18 +732,31 @@ class cleanError(Exception):
 
 class cleanRefs:
 
-    def __init__(self, tag, baseDir, verbose, arxiv):
+    def __init__(self, tag, baseDir, verbose, arxiv, cacheDir=None, cacheSize=256, quiet=False):
         """
         :param tag: document tag
         :param baseDir: directory containing the log files
         :param verbose: turn up logging level
         :param arxiv: remove arXiv info if doi present
+        :param cacheDir: directory for the cache of parsed bib files (no caching if None)
+        :param cacheSize: size limit of the cache in MB
+        :param quiet: only collect the findings, without printing
         """
         self._tag = tag
         self._refs = [] # references from paper: bibkey
+        self._citeCounts = collections.Counter() # number of \citation lines naming each bibkey
+        self._bibcite = collections.OrderedDict() # \bibcite label of each bibkey, in bibliography order
+        self._findings = [] # finding records, in the order reported
+        self._quiet = quiet
         self._verbosity = verbose
         self._arxiv = arxiv
         self._bib = {} #dictionary (keyed on bibkey in bib file (same as used in _refs)) which holds the citation tuple (artType, {fieldName:fieldValue}), key is 
+        self._spans = {} # (start, end) byte offsets of each _bib entry in the bib file, from '@' to the closing brace
+        self._duplicates = [] # (bibkey, span) of the discarded duplicate entries
+        self._encoding = None # encoding of the bib file
+        self._bibDigest = None # content hash of the bib file, as read
+        self._dupIndex = None # duplicateIndex of _bib, built on first use
+        self._required = None # requiredRefs, the shipped registry unless loadRequired is used
         self._rules =[ ('VOLUME',re.compile(r'[A-G]\s*\d'),'Volume with serial number','Error'),
                        ('VOLUME',re.compile(r'\\bf'), r'Volume with \bf','Error'), # change to be any control sequence
                        ('VOLUME',re.compile('CMS'), 'PAS as article? Please use TECHREPORT','Error'),
@@ -119,140 +785,202 @@ class cleanRefs:
                        ('COLLABORATION',re.compile(r'Collaboration'), r'Should not normally use Collaboration: already in the format','Error'), 
                        ('LANGUAGE',re.compile('.*'),'Language entry requires loading the babel package, which is not used','Error for APS'),
                        ('PAGES',  re.compile('-'), 'Range in page field: we only use first page','Warning') ] # rules for checking format: field, compiled re, message. (Add severity?)
-        self._blankCheck = re.compile(r'^\s+$')
+        self._engine = ruleEngine(self._rules)
+        self._engine.addVisitor(checkTechreport, 'TECHREPORT')
+        self._engine.addVisitor(checkArticle, 'ARTICLE')
+        self._engine.addVisitor(checkAuthorCount)
+        self._engine.addVisitor(checkDoiAndUrl)
+        self._engine.addVisitor(checkBlankFields)
         # field ordering not yet implemented (if ever)
         self._fieldOrder = ('AUTHOR','COLLABORATION','TITLE','DOI','JOURNAL','VOLUME','TYPE','NUMBER','YEAR','PAGES','NOTE','URL','EPRINT','ARCHIVEPREFIX') #SLACCITATION always last
         # self._baseDir = r'C:\Users\George Alverson\Documents\CMS\tdr2\utils\trunk\tmp\\'
         self._baseDir = baseDir
+        self._cache = bibCache(cacheDir, cacheSize) if cacheDir else None
         self._sissaJournals =  tuple(['JHEP', 'J. High Energy Phys.', 'J. High Energy Physics', 'JINST', 'J. Instrum.', 'J. Instrumentation'])  # not including JSTAT or JCAP
 
 
         
+    def report(self, key, check, msg):
+        """Record a finding and print it
+
+        :param key: bib key, or None for document-wide checks
+        :param check: name of the check
+        :param msg: message text
+        """
+        self._findings.append(finding(self._tag, key, check, msg))
+        self.log(msg)
+
+    def log(self, *args, **kwargs):
+        """print, unless quiet"""
+        if not self._quiet:
+            print(*args, **kwargs)
+
+    def loadRules(self, filename):
+        """Add the format rules from a data file (see ruleEngine.loadRules)
+
+        :param filename: name of the JSON rules file
+        """
+        self._rules.extend(self._engine.loadRules(filename))
+
+    def loadRequired(self, filename=None, era=None, docType=None):
+        """Select the required references to check for (see requiredRefs.load)
+
+        :param filename: name of the JSON registry (default: the one shipped with this script)
+        :param era: analysis era
+        :param docType: document type
+        """
+        self._required = requiredRefs.load(filename, era, docType)
+
     def getRefList(self):
-        r"""Open the aux file and extract the \citation lines, adding the citations contained to an ordered list, which should match the bibtex reference order.
+        r"""Scan the aux file, and the aux files it inputs, for the \citation and \bibcite lines, adding the citations contained to an ordered list, which should match the bibtex reference order.
            """
         #\citation{Dawson:1983fw,Beenakker:1996ch,Plehn:2005cq,Beenakker:2009ha}
-
-        # Use \bibcite instead? What about multi-refs?
         #\bibcite{Beenakker:2009ha}{{10}{}{{}}{{}}}
-        badrefs = ['REVTEX41Control', 'apsrev41Control']
-
-        file =  os.path.join(self._baseDir,self._tag + '_temp.aux')
-        f = io.open(file,'r')
-        refs = []
-        for line in f:
-            if line.startswith('\\citation'):
-                newrefs = line[10:len(line)-2].split(',')
-                #tested = newrefs in badrefs
-                if not (newrefs[0] in badrefs):
-                    refs.extend(newrefs)
-                #print(refs)
-        self._refs = f5(refs)
-        f.close()
+        #\@input{chapter1.aux}
+        index = auxIndex(self._baseDir).scan(self._tag + '_temp.aux')
+        if not index.files:
+            raise IOError("No aux file {0}".format(os.path.join(self._baseDir, self._tag + '_temp.aux')))
+        self._refs = index.keys
+        self._citeCounts = index.counts
+        self._bibcite = index.labels
+        if self._verbosity > 1:
+            self.log("Found {0} citations of {1} keys in {2} aux files.".format(sum(index.counts.values()), len(index.keys), len(index.files)))
 
     def getRefs(self):
         """Open the bibfile and scan for "@artType{citation,", where citation matches one we are looking for. Extract the fields
            """
         file = os.path.join(self._baseDir,'auto_generated.bib')
-        bibparse = re.compile(r'^\s*@(\S*)\s*\{',re.MULTILINE) # look for an entire bib entry
-        tagparse = re.compile(r'^\s*(\S*)\s*,',re.MULTILINE) # find the bib tag
-        f = io.open(file,'r')
-        try:
-            bibs = f.read()
-        except UnicodeDecodeError:
-            print('>>Unicode detected. {0} contains Unicode characters (typically quote marks or ligatures from cut and paste from Word). These are not allowed with the standard BibTex (requires BibTeX8).'.format(file))
-            f.close()
-            f = io.open(file,'rb')
-            text = f.read()
-            # check for Unicode characters
-            p8 = re.compile(b"[\x80-\xFF]",re.DOTALL)
-            pm = p8.findall(text)
-            for cand in pm:
-                index = text.find(cand)
-                print("...Byte {0}: {1}".format(index,text[index:index+25]))
-            f.close()
-            print('Continuing using Unicode...')
-            f = io.open(file,'r',encoding="UTF-8")
-            bibs = f.read()
-        f.close()
-        p = 0
-        m = bibparse.search(bibs[p:])
-        while m:
-            artType = m.group(1).upper()
-            [pout, body] = extractBalanced(bibs[p+m.end(0)-1:],'{')
-            if (artType != u'COMMENT'):
-                t = tagparse.match(body)
-                if (t):
-                    tag = t.group(1)
-                    items = self.parseBody(tag, body[t.end(0):])
-                    if tag in self._bib.keys():
-                        print(">>> Duplicate entry for {0} being discarded".format(tag))
-                    else:
-                        self._bib[tag] = (artType, items)
+        with io.open(file,'rb') as f:
+            raw = f.read()
+        self._bibDigest = hashlib.sha256(raw).hexdigest()
+        parsed = None
+        if self._cache or _parseMemo is not None:
+            cacheKey = bibCache.key(raw)
+            if _parseMemo is not None and cacheKey in _parseMemo:
+                _parseMemo[cacheKey] = _parseMemo.pop(cacheKey) # most recently used last
+                parsed = marshal.loads(_parseMemo[cacheKey])
+            elif self._cache:
+                parsed = self._cache.load(cacheKey)
+        if parsed:
+            (self._bib, self._spans, self._duplicates, self._encoding) = parsed
+            if self._encoding != locale.getpreferredencoding(False):
+                # the parse fell back to UTF-8: repeat its diagnostics, so that warm runs flag the bib as cold ones do
+                self.unicodeDiagnostics(file, raw)
+            for (tag, span) in self._duplicates:
+                self.report(tag, 'duplicateEntry', ">>> Duplicate entry for {0} being discarded".format(tag))
+            if self._verbosity > 1:
+                self.log("Using cached parse of {0}".format(file))
+        else:
+            bibs = self.decodeBib(file, raw)
+            entries = [] # (bibkey, span, kept)
+            for (artType, tag, items, span) in tokenizeBib(bibs):
+                if self._verbosity > 2:
+                    self.printFields(items)
+                if tag in self._bib.keys():
+                    self.report(tag, 'duplicateEntry', ">>> Duplicate entry for {0} being discarded".format(tag))
+                    entries.append((tag, span, False))
                 else:
-                    raise cleanError("WARNING: Could not find a tag in string starting with: {0}".format(body.strip()[0:min([len(body.strip()), 25])])) 
-            p = p + m.end(0) -1 + pout
-            m = bibparse.search(bibs[p:])
+                    self._bib[tag] = (artType, items)
+                    entries.append((tag, span, True))
+            # spans in bytes, so that rewrite can copy unchanged entries straight from the file
+            offsets = byteOffsets(bibs, raw, self._encoding, [c for (tag, span, kept) in entries for c in span])
+            for (i, (tag, span, kept)) in enumerate(entries):
+                span = (offsets[2*i], offsets[2*i+1])
+                if kept:
+                    self._spans[tag] = span
+                else:
+                    self._duplicates.append((tag, span))
+            if self._cache:
+                self._cache.store(cacheKey, (self._bib, self._spans, self._duplicates, self._encoding))
+        if _parseMemo is not None and not cacheKey in _parseMemo:
+            _parseMemo[cacheKey] = marshal.dumps((self._bib, self._spans, self._duplicates, self._encoding))
+            while len(_parseMemo) > _parseMemoSize:
+                _parseMemo.popitem(last=False)
+        self._dupIndex = None
         if self._verbosity > 1:
-            print("Found {0} entries in the bib file. There were {1} used in the aux file.".format(len(self._bib),len(self._refs)))
+            self.log("Found {0} entries in the bib file. There were {1} used in the aux file.".format(len(self._bib),len(self._refs)))
             
 
 
 
+    def decodeBib(self, file, raw):
+        """Decode the bib file contents as a text-mode read would: default encoding and universal newlines.
+           Falls back to UTF-8, with diagnostics, if the bib is not in the default encoding.
+
+           :param file: the bib file name, for messages
+           :param raw: the bib file contents (bytes)"""
+        self._encoding = locale.getpreferredencoding(False)
+        try:
+            bibs = raw.decode(self._encoding)
+        except UnicodeDecodeError:
+            self.unicodeDiagnostics(file, raw)
+            self._encoding = "UTF-8"
+            bibs = raw.decode(self._encoding)
+        if '\r' in bibs:
+            bibs = _newlines.sub('\n', bibs)
+        return bibs
+
+    def unicodeDiagnostics(self, file, raw):
+        """Report a bib file that is not in the default encoding, and each run of non-ASCII bytes where it actually is
+
+           :param file: the bib file name, for messages
+           :param raw: the bib file contents (bytes)"""
+        self.report(None, 'unicode', '>>Unicode detected. {0} contains Unicode characters (typically quote marks or ligatures from cut and paste from Word). These are not allowed with the standard BibTex (requires BibTeX8).'.format(file))
+        for offset, line, column, key, run in nonAsciiRuns(raw):
+            self.log("...Byte {0} (line {1}, column {2}, entry {3}): {4}".format(offset, line, column, key, raw[offset:offset+max(25, len(run))]))
+        self.log('Continuing using Unicode...')
+
     def parseBody(self, tag, body):
         """extract the tag and the fields from a citation
         
            :param tag: the document tag, e.g. XXX-08-000
            :param body: the bib body text"""
 
-        # need to protect against "=" inside a URL.
-        fieldparse = re.compile(r'\s*(\S*)\s*=\s*(\S)',re.MULTILINE)
-        trim = re.compile(r'\s{2,}|\n',re.MULTILINE) # what about \r
-        p = 0
-        m = fieldparse.search(body[p:])
-        entry = {}
-        while m:
-            field = m.group(1).upper()
-            [pout, value] = extractBalanced(body[p+m.end(0)-1:],m.group(2))
-            value = trim.sub(' ',value)
-            entry[field] = value
-            p = p + m.end(0) -1 + pout
-            m = fieldparse.search(body[p:])
-
+        entry = parseFields(body, 0, len(body))
         if self._verbosity > 2:
-            for key in entry.keys():
-                print("{0}\t: {1}".format(key, entry[key]))
+            self.printFields(entry)
 
         return entry
 
+    def printFields(self, entry):
+        """print out the fields of a parsed citation
+
+           :param entry: dictionary of {fieldName:fieldValue}"""
+        for key in entry.keys():
+            self.log("{0}\t: {1}".format(key, entry[key]))
+
+    def duplicateIndex(self):
+        """ The duplicateIndex of the bib file, built once per bib load """
+        if self._dupIndex is None:
+            self._dupIndex = duplicateIndex(self._bib)
+        return self._dupIndex
+
     def checkForDuplicates(self, checkItems, checkTag):
         """ duplicate entry check (uses doi as unique marker)
-        :param checkItems:
-        :param checkTag:
+        :param checkItems: bib entries in the usual format
+        :param checkTag: field to check: DOI, EPRINT or URL
         """
-        # python 2.7 and later only
-        chklist = [v[checkTag] for (v,j) in ((vv[1],i) for i, vv in checkItems.items()) if checkTag in v and j in self._refs]
-        if (len(chklist) > len(set(chklist))):
-            print('Have duplicate used ',checkTag,'s',sep="")
-            print([v for v, vv in collections.Counter(chklist).items() if vv > 1])
+        index = self.duplicateIndex() if checkItems is self._bib else duplicateIndex(checkItems)
+        used = index.exact(checkTag, set(self._refs))
+        if used:
+            self.report(None, 'checkForDuplicates', 'Have duplicate used {0}s\n{1}'.format(checkTag, list(used.keys())))
         else:
-            print('No duplicate ',checkTag,'s used.',sep="")
-        c = dict()
-        for k,v in self._bib.items():
-            if (checkTag in v[1].keys()):
-                t = v[1][checkTag]
-                if t in c:
-                    c[t].append(k)
-                else:
-                    c[t] = [k,]
-        print('All duplicate ',checkTag,'s',' found in the bibfile...',sep="")
+            self.log('No duplicate ',checkTag,'s used.',sep="")
+        self.log('All duplicate ',checkTag,'s',' found in the bibfile...',sep="")
         dupes = False
-        for k,v in c.items():
-            if len(v)>1:
-                print("\t",k,": ",v)
-                dupes = True
+        for k,v in index.exact(checkTag).items():
+            self.report(None, 'checkForDuplicates', "\t {0} :  {1}".format(k, v))
+            dupes = True
         if not dupes:
-            print('\t...none')
+            self.log('\t...none')
+
+    def checkForNearDuplicates(self):
+        """ near-duplicate check on title and first author, for the cited entries """
+        pairs = self.duplicateIndex().near(set(self._refs))
+        for (a, b, similarity) in pairs:
+            self.report(a, 'checkForNearDuplicates', '{0}, {1}:\t Possible duplicate entries: same first author and similar titles ({2:.0%}).'.format(a, b, similarity))
+        if not pairs:
+            self.log('No near-duplicate entries used.')
 
     def checkForHEPData(self, checkItems):
         """ Should have a HEPData reference
@@ -260,144 +988,62 @@ class cleanRefs:
         """
 
         if not 'HEPDATA' in [i.upper() for i in checkItems.keys()]:
-            print("No HEPdata entry found. Looked for key 'HEPData'.\n")
+            self.report(None, 'checkForHEPData', "No HEPdata entry found. Looked for key 'HEPData'.\n")
             return False
         else:
             return True
 
 
 
-    def checkReqRef(self, checkItems, msg, doi=None, url=None):
-        """ Check to make sure that the required references are included.
-            
-            Examples are:
-            CMS trigger system paper (10.1088/1748-0221/12/01/P01020) [for all Run 2 papers (and following)...for now just check all papers]
-            CMS lumi paper/PASs
-             
-        :param checkItems: list of bib entries in the usual format
-        :param msg: message to print out for missing reference
-        :param doi: required DOI if checking by DOI
-        :param url: required URL if checking by URL. Only looks for presence of string, not complete match, so allows check by CDS ID.
-        :return: True if ref found, False otherwise. Msg printed if False.
-        """
-
-        check = True
+    def checkRequired(self):
+        """ Check that the required references (CMS trigger paper, luminosity papers/PASs, ...) are cited
 
-        if doi:
-            chklist = [v['DOI'] for (v,j) in ((vv[1],i) for i, vv in checkItems.items()) if 'DOI' in v and j in self._refs]
-            if not doi in chklist:
-                print(msg)
-                check = False
-
-        if url:
-            chklist = [url in v['URL'] for (v,j) in ((vv[1],i) for i, vv in checkItems.items()) if 'URL' in v and j in self._refs]
-            if not True in chklist:
-                print(msg) 
-                check = False
-
-        return check
+        :return: True if all are found. A message is printed for each one missing.
+        """
+        if self._required is None:
+            self.loadRequired()
+        missing = self._required.missing(self._bib, self._refs)
+        for ref in missing:
+            self.report(None, 'checkReqRef', ref['message'])
+        return not missing
 
 
     def checkRefs(self):
         """Correlate citations against bib file and check for common errors"""
 
-        print("\n>>> Checking references against CMS rules\n")
-        no_collab_rule = re.compile('Collaboration') # to check for a Collaboration as author: not _generally_ okay for papers
+        self.log("\n>>> Checking references against CMS rules\n")
 
         for key in self._refs:
             if not key in self._bib:
-                print("Missing bib entry for citation {0}. May be an upper/lower case problem (ignorable)".format(key))
+                self.report(key, 'missing', "Missing bib entry for citation {0}. May be an upper/lower case problem (ignorable)".format(key))
             else:
-                #
-                # rule-based checks on particular fields
-                #
-                for rule in self._rules:
-                    fieldName = rule[0]
-                    if fieldName in self._bib[key][1].keys():
-                        m = rule[1].search(self._bib[key][1][fieldName])
-                        if m:
-                            print("{0}:\t {1} {3}: {2}.".format(key, rule[0], rule[2], rule[3]))
-                #
-                # ad hoc checks
-                #
-                if self._bib[key][0]=='TECHREPORT':
-                    # Some techreports have DOIs, so it's OK for them to not have a URL in that case
-                    if not 'URL' in self._bib[key][1].keys() and not 'DOI' in self._bib[key][1].keys():
-                        print('{0}:\t Missing URL for Techreport '.format(key))
-                if self._bib[key][0]=='ARTICLE':
-                    if not 'AUTHOR' in self._bib[key][1].keys():
-                        print('{0}:\t Missing AUTHOR '.format(key))
-                    else:
-                        m = no_collab_rule.search(self._bib[key][1]['AUTHOR'])
-                        if m:
-                            print("{0}:\t {1} listed as author. Please check this is correct.".format(key, self._bib[key][1]['AUTHOR']))                                           
-                    if not 'DOI' in self._bib[key][1].keys():
-                        print('{0}:\t Missing DOI '.format(key))
-                    if not 'EPRINT' in self._bib[key][1].keys():
-                        print('{0}:\t Missing EPRINT '.format(key))
-                    if not 'JOURNAL' in self._bib[key][1].keys():
-                        print('{0}:\t Missing JOURNAL. Reformat as UNPUBLISHED?'.format(key))
-                    else:
-                    ## check for wrong number of digits in JHEP volume: must be two
-                        if (self._bib[key][1]['JOURNAL']==u'JHEP' or self._bib[key][1]['JOURNAL']==u'J. High Energy Phys.') and not re.match('^[0-9]{2}$',self._bib[key][1]['VOLUME']):
-                            print('{0}:\t JHEP volume number given as {1}: should always be exactly two digits (0 left padded).'.format(key,self._bib[key][1]['VOLUME']))
-                # number of authors check
-                if 'AUTHOR' in self._bib[key][1].keys():
-                    etal = re.search(' and others', self._bib[key][1]['AUTHOR']) 
-                    authors_list = re.findall(" and ", self._bib[key][1]['AUTHOR'])
-                    #print('{0}'.format(self._bib[key][1]['AUTHOR']))
-                    nauthors = len(authors_list) + 1
-                    if etal:
-                        nauthors = nauthors - 1
-                    collab = 'COLLABORATION' in self._bib[key][1].keys()
-                    # here's the actual test 
-                    if (nauthors > 1) and etal and collab:
-                        print('{0}:\t Author count. More authors than necessary for a paper with a collaboration. List only the first plus "and others".'.format(key))
-                    if (nauthors > 1 and nauthors < 15) and etal and not(collab):
-                        print('{0}:\t Author count. Incomplete author list. Include all authors for lists as long as 15'.format(key))
-                    if (nauthors > 15) and ~collab:
-                        print('{0}:\t Author count. More authors than necessary. Include only the first author plus "and others" for lists longer than 15.'.format(key))
-                    if (nauthors==1) and etal and not(collab):
-                        print('{0}:\t Author count query. Are there really more than 15 authors for this reference?'.format(key))
-                    # diagnostic
-                    # print('{0}:\t Number of authors {1} '.format(key, nauthors))
-
-                # check for both url and doi
-                if 'DOI' in self._bib[key][1].keys() and 'URL' in self._bib[key][1].keys():
-                    print('{0}:\t Both DOI and URL. DOI only is preferred.'.format(key))
-                
-                # empty/blank field check
-                for item in self._bib[key][1].items():
-                    if not item[1]:
-                        print('{1}: Empty value for field {0}'.format(item[0],key))
-                    m = self._blankCheck.search(item[1])
-                    if m:
-                        print('{1}: Blank value for field {0}'.format(item[0],key))                        
-                #print(self.printCite(key))
-        print(">   Checking references against general tests   <")
-        self.checkReqRef(self._bib, doi='10.1088/1748-0221/12/01/P01020', msg='>>Run 1 trigger citation, TRG-12-001, http://dx.doi.org/10.1088/1748-0221/12/01/P01020 was not cited. Should be included for both Run 1 and Run 2.')
-        self.checkReqRef(self._bib, doi='10.1140/epjc/s10052-021-09538-2', msg='>>Luminosity reference (LUM-17-003) missing.')
-        self.checkReqRef(self._bib, url='2621960', msg='>LUM-17-004 reference missing')
-        self.checkReqRef(self._bib, url='2676164', msg='>LUM-18-002 reference missing')
+                # rule-based checks on particular fields, then the ad hoc checks
+                for (check, msg) in self._engine.check(key, *self._bib[key]):
+                    self.report(key, check, msg)
+        self.log(">   Checking references against general tests   <")
+        self.checkRequired()
         self.checkForHEPData(self._bib)
         self.checkForDuplicates(self._bib,'DOI')
         self.checkForDuplicates(self._bib,'EPRINT')
+        self.checkForDuplicates(self._bib,'URL')
+        self.checkForNearDuplicates()
 
 
 
 
 
     def rewrite(self):
-        """Write out a new bib file. Default for now is just to reset the collab field"""
+        """Rewrite the bib file in place, with the cited entries only. Default for now is just to reset the collab field.
+           Only the entries actually changed are re-serialized: the others are copied verbatim from the original."""
 
         if self._verbosity > 2:
             print("\n>>>rewrite: Rewriting a new bib file\n")
         outfile = os.path.join(self._baseDir,'auto_generated.bib') # overwrite original
-        f = io.open(outfile,'w')
-
 
+        changed = set()
         for key in self._refs:
             if key in self._bib:
+                before = (self._bib[key][0], dict(self._bib[key][1]))
                 if ('COLLABORATION' in self._bib[key][1].keys() and self._bib[key][1]['COLLABORATION'] in ['CMS', 'ATLAS', 'LHCb', 'ALICE', '{CMS}', '{ATLAS}', '{LHCb}', '{ALICE}']):
 
                     self._bib[key][1]['AUTHOR'] = '{'+(self._bib[key][1]['COLLABORATION']).strip('{}')+' Collaboration}'
@@ -416,10 +1062,54 @@ class cleanRefs:
                         if ('HOWPUBLISHED' in self._bib[key][1]):
                             self._bib[key][1]['TITLE'] = self._bib[key][1]['HOWPUBLISHED']
                             del self._bib[key][1]['HOWPUBLISHED'] 
-                f.write(self.printCite(key))
+                if (self._bib[key][0], self._bib[key][1]) != before:
+                    changed.add(key)
             else:
-                print("\n> Skipping citation {0}".format(key))
-        f.close()
+                self.log("\n> Skipping citation {0}".format(key))
+        nwritten = self.writeBib(outfile, changed)
+        self.log("\n>>>rewrite: {0} of {1} cited entries changed, {2} bytes re-serialized".format(len(changed), len([key for key in self._refs if key in self._bib]), nwritten))
+        return len(changed)
+
+    def writeBib(self, outfile, changed):
+        """Incremental write of the bib file: the cited entries, in citation order, as the full rewrite with printCite wrote them.
+           The changed entries are re-serialized with printCite, the others are copied from the memory-mapped original.
+           The result is written to a temporary file which then atomically replaces the original.
+
+           :param outfile: the bib file, as read by getRefs
+           :param changed: keys of the entries to re-serialize
+           :return: number of bytes re-serialized"""
+        nwritten = 0
+        with io.open(outfile, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            try:
+                if hashlib.sha256(mm).hexdigest() != self._bibDigest:
+                    raise cleanError("{0} was modified after it was read. Not rewriting.".format(outfile))
+                newline = b'\r\n' if mm.find(b'\r\n') >= 0 else b'\n' # keep DOS line ends
+                (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)), prefix='.auto_generated.', suffix='.tmp')
+                try:
+                    with io.open(fd, 'wb') as out:
+                        for key in self._refs:
+                            if not key in self._bib:
+                                continue
+                            if key in changed:
+                                text = self.printCite(key)[:-1].encode(self._encoding).replace(b'\n', newline)
+                                nwritten += len(text)
+                            else:
+                                (start, end) = self._spans[key]
+                                text = mm[start:end]
+                            out.write(text)
+                            out.write(newline)
+                    shutil.copymode(outfile, tmp)
+                    replaceFile(tmp, outfile)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+            finally:
+                if size:
+                    mm.close()
+        return nwritten
 
     def sissaFix(self, key):
         # APS formats the year as the volume and the volume as the number. adjust ours here
@@ -467,10 +1157,99 @@ class cleanRefs:
 
 
 
+def batchJobs(specs, listFile=None):
+    """ Expand the document specifications for a batch run into (tag, baseDir) pairs
+
+    :param specs: list of "TAG=DIR" or plain DIR entries; DIR may be a glob. For plain entries the tags are taken from the <tag>_temp.aux files found in each directory
+    :param listFile: optional file with one "tag baseDir" pair per line
+    :return: list of (tag, baseDir)
+    """
+    jobs = []
+    for spec in specs:
+        if '=' in spec:
+            (tag, pattern) = spec.split('=', 1)
+            jobs.extend((tag, d) for d in sorted(glob.glob(pattern)) if os.path.isdir(d))
+        else:
+            for d in sorted(glob.glob(spec)):
+                for aux in sorted(glob.glob(os.path.join(d, '*_temp.aux'))):
+                    jobs.append((os.path.basename(aux)[:-len('_temp.aux')], d))
+    if listFile:
+        with io.open(listFile, 'r') as f:
+            for line in f:
+                fields = line.split('#')[0].split()
+                if len(fields) == 2:
+                    jobs.append(tuple(fields))
+    return jobs
+
+def _batchInit(options):
+    """ set up a batch worker: options are the cleanRefs arguments after tag and baseDir, plus the rule files and the required-reference selection """
+    global _parseMemo, _batchOptions
+    _parseMemo = collections.OrderedDict()
+    _batchOptions = options
+
+def _batchCheck(job):
+    """ check one document in a batch worker
+
+    :param job: (tag, baseDir)
+    :return: (tag, baseDir, findings, wall time, error message or None)
+    """
+    (tag, baseDir) = job
+    (verbose, arxiv, cacheDir, cacheSize, rules, required) = _batchOptions
+    t0 = time.time()
+    myRefs = None
+    error = None
+    try:
+        myRefs = cleanRefs(tag, baseDir, verbose, arxiv, cacheDir, cacheSize, quiet=True)
+        for r in rules:
+            myRefs.loadRules(r)
+        if required:
+            myRefs.loadRequired(*required)
+        myRefs.getRefList()
+        myRefs.getRefs()
+        myRefs.checkRefs()
+    except Exception as e:
+        error = '{0}: {1}'.format(type(e).__name__, e)
+    return (tag, baseDir, myRefs._findings if myRefs else [], time.time() - t0, error)
+
+def runBatch(jobs, nworkers, verbose, arxiv, cacheDir=None, cacheSize=256, rules=(), required=None):
+    """ Check many documents on a pool of worker processes and print one merged report.
+        Each worker parses a given bib file (by content) only once.
+
+    :param jobs: list of (tag, baseDir), as from batchJobs
+    :param nworkers: number of worker processes
+    :param required: (registry file, era, docType) for cleanRefs.loadRequired, or None for the shipped registry
+    :return: list of (tag, baseDir, findings, wall time, error message or None), in the order of jobs
+    """
+    options = (verbose, arxiv, cacheDir, cacheSize, list(rules), required)
+    t0 = time.time()
+    if nworkers > 1:
+        pool = multiprocessing.Pool(nworkers, _batchInit, (options,))
+        results = pool.map(_batchCheck, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        _batchInit(options)
+        results = [_batchCheck(job) for job in jobs]
+    elapsed = time.time() - t0
+
+    print("\n>>> Batch report: {0} documents\n".format(len(results)))
+    for (tag, baseDir, findings, wall, error) in results:
+        print("=== {0} ({1}): {2} findings ===".format(tag, baseDir, len(findings)))
+        for f in findings:
+            print(f.message)
+        if error:
+            print(">>> Check failed: {0}".format(error))
+    print("\n>>> Wall time per document\n")
+    width = max([len(r[0]) for r in results] + [8])
+    for (tag, baseDir, findings, wall, error) in results:
+        print("{0:<{1}} {2:8.2f} s {3:6d} findings{4}".format(tag, width, wall, len(findings), '  FAILED' if error else ''))
+    print("{0:<{1}} {2:8.2f} s on {3} workers".format('total', width, elapsed, nworkers))
+    return results
+
 def main(argv):
     from optparse import OptionParser
 
-    usage = "Usage: %prog [options]  tag"
+    usage = "Usage: %prog [options]  tag\n       %prog [options] --batch [TAG=]DIR..."
     pat = re.compile(r"\$Revision:\s+(\d+)\s+\$")
     global version
     versionOK = pat.search(__version__)
@@ -483,12 +1262,26 @@ def main(argv):
                         help="trace script execution; repeated use increases the verbosity more")
     parser.add_option("-b",  "--base", action="store", dest="base", help="base of build area", default=r"D:\tdr2\utils\trunk\tmp")
     parser.add_option("-r", "--rewrite", action="store_true", dest="rewrite", default=False, help="rewrites the bib file and overwrites in base directory")
+    parser.add_option("--rules", action="append", dest="rules", default=[], help="JSON file of additional rules: a list of {field, pattern, message, severity}; may be repeated")
+    parser.add_option("--required", action="store", dest="required", default=None, help="JSON registry of required references, keyed by era and document type (default: requiredRefs.json next to this script)")
+    parser.add_option("--era", action="store", dest="era", default=None, help="analysis era (e.g. Run2) selecting the required references")
+    parser.add_option("--doc-type", action="store", dest="docType", default=None, help="document type (e.g. paper, pas) selecting the required references")
+    parser.add_option("--cache-dir", action="store", dest="cacheDir", default=None, help="directory for a persistent cache of parsed bib files (default: no cache)")
+    parser.add_option("--cache-size", action="store", type="int", dest="cacheSize", default=256, help="size limit of the bib cache in MB; least recently used entries are evicted. Default: 256")
+    parser.add_option("--batch", action="store_true", dest="batch", default=False, help="check many documents: arguments are TAG=DIR or DIR (tags from the <tag>_temp.aux files); DIR may be a glob")
+    parser.add_option("--batch-file", action="store", dest="batchFile", default=None, help="file listing 'tag baseDir' pairs for --batch, one per line")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=multiprocessing.cpu_count(), help="number of worker processes for --batch. Default: number of CPUs")
     parser.add_option("--no-arxiv", action="store_false", dest="arxiv", default=True, help="removes arxiv info when doi is supplied; also replaces JINST by J. Instrum.")
     global opts
     (opts, args) = parser.parse_args()
     if opts.verbose:
         print("\tVerbosity = {0}".format(opts.verbose))
         print(opts)
+    if opts.batch:
+        runBatch(batchJobs(args, opts.batchFile), opts.jobs, opts.verbose, opts.arxiv, opts.cacheDir, opts.cacheSize, opts.rules,
+                 (opts.required, opts.era, opts.docType))
+        return
+
     tag = ""
     if len(args) > 0:
         tag = args[len(args)-1]
@@ -499,7 +1292,10 @@ def main(argv):
         
    
  
-    myRefs = cleanRefs(tag, opts.base, opts.verbose, opts.arxiv)
+    myRefs = cleanRefs(tag, opts.base, opts.verbose, opts.arxiv, opts.cacheDir, opts.cacheSize)
+    for rules in opts.rules:
+        myRefs.loadRules(rules)
+    myRefs.loadRequired(opts.required, opts.era, opts.docType)
     myRefs.getRefList()
     myRefs.getRefs()
     myRefs.checkRefs()
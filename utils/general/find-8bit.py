@@ -11,48 +11,111 @@ import re
 import os
 import string
 import glob
+import mmap
+import bisect
 import unicodedata
+import multiprocessing
 
 unicodeConsole = 'utf8' 
+contextWidth = 60 # characters of the line shown on either side of the non-ASCII characters
 
-def scan8(body):
-	""" Scan over the text fragment 
+highBytes = re.compile(b"[\\x80-\\xFF]+") # UTF-8 encodes every non-ASCII character, and only those, in bytes x80-xFF
+newline = re.compile(b"\\n")
 
-	:arg body: the suspect text
+def scan8(body, name=""):
+	""" Scan over the text fragment, at the byte level: only the lines with non-ASCII characters are decoded
+
+	:arg body: the suspect text, UTF-8 encoded: bytes or a memory map
+	:arg name: the file name, for the file:line:col locations
+	:return: the report, as a list of lines
 	"""
 
-	p0 = re.compile("[^\\x00-\\x7F]")
-	pm0 = p0.search(body)
-	if pm0:
-		p = re.compile("(.*?)([^\\x00-\\x7F]+)(.*?)")
-		start = 0
-		pm = p.search(body,start)
-		while pm:
-			plain = ', '.join([unicodedata.name(c, "Unknown") for c in pm.group(2) ])
-			print(">non-ASCII characters {} at positions {}-{}".format(plain, pm.start(2),pm.end(2)))
-			if unicodeConsole:
-
-				print(">{}>>...<<{}".format(pm.group(1),pm.group(3)))
-				print(">{}>>{}<<{}".format(pm.group(1),pm.group(2),pm.group(3)))
+	report = []
+	lineStarts = None
+	(lastLine, lastPos, lastCol) = (0, 0, 0) # previous report, from which the column is counted on in the same line
+	pm = highBytes.search(body)
+	while pm:
+		if lineStarts is None:
+			# newline index, built once and only for files with something to report
+			lineStarts = [0] + [m.end() for m in newline.finditer(body)]
+		line = bisect.bisect_right(lineStarts, pm.start())
+		lineStart = lineStarts[line-1]
+		lineEnd = lineStarts[line]-1 if line < len(lineStarts) else len(body)
+		if line != lastLine:
+			(lastLine, lastPos, lastCol) = (line, lineStart, 0)
+		col = lastCol + len(body[lastPos:pm.start()].decode("utf-8", "replace"))
+		location = "{}:{}:{}".format(name, line, col+1)
+		try:
+			chars = body[pm.start():pm.end()].decode("utf-8")
+		except UnicodeDecodeError:
+			chars = body[pm.start():pm.end()].decode("utf-8", "replace")
+			report.append(">{}: invalid UTF-8 bytes {} at bytes {}-{}".format(location, body[pm.start():pm.end()].hex(), pm.start(), pm.end()))
+		else:
+			plain = ', '.join([unicodedata.name(c, "Unknown") for c in chars ])
+			report.append(">{}: non-ASCII characters {} at bytes {}-{}".format(location, plain, pm.start(), pm.end()))
+		(lastPos, lastCol) = (pm.end(), col + len(chars))
+		# context from the same line, decoding no more than it shows
+		before = body[max(lineStart, pm.start()-4*contextWidth):pm.start()].decode("utf-8", "replace")[-contextWidth:]
+		after = body[pm.end():min(lineEnd, pm.end()+4*contextWidth)].decode("utf-8", "replace").rstrip("\r")[:contextWidth]
+		if unicodeConsole:
+			report.append(">{}>>...<<{}".format(before,after))
+			report.append(">{}>>{}<<{}".format(before,chars,after))
+		else:
+			report.append(">{}^{}".format(before,after))
+		pm = highBytes.search(body, pm.end())
+
+	return report
+
+def scanFile(file):
+	""" Scan a file, memory mapped
+
+	:arg file: the file name
+	:return: (file name, report lines), the report empty if there is no non-ASCII character
+	"""
+	with open(file, "rb") as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return (file, [])
+		body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			return (file, scan8(body, file))
+		finally:
+			body.close()
+
+def findFiles(args, extensions):
+	""" The files to scan: glob patterns, with ** for any subdirectory, and directories, searched for the given extensions
+
+	:arg args: the file names, patterns or directories
+	:arg extensions: the file extensions looked for in directories
+	:return: the list of files, and the list of matches that are neither files nor directories
+	"""
+	files = []
+	skipped = []
+	for arg in args:
+		for file in sorted(glob.glob(arg, recursive=True)):
+			if os.path.isfile(file):
+				files.append(file)
+			elif os.path.isdir(file):
+				for (root, dirs, names) in os.walk(file):
+					dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+					files += [os.path.join(root, n) for n in sorted(names) if os.path.splitext(n)[1][1:] in extensions]
 			else:
-				try:
-					print(">{}^{}".format(pm.group(1),pm.group(3)))
-				except UnicodeEncodeError:
-					print(">{}... + additional Unicode in the same line".format(pm.group(1)))
-			pm = p.search(body,pm.end(2))
-	else:
-		print("No Unicode characters (x80-xFF) found")	
-
-	return
+				skipped.append(file)
+	return (files, skipped)
 
 def main(argv):
 	import sys
 	from optparse import OptionParser
 
-	usage = "Usage: %prog [options]  [filenames]"
+	usage = "Usage: %prog [options]  [filenames, patterns (with ** for subdirectories) or directories]"
 	version = __version__
 	global opts
 	parser = OptionParser(usage=usage, version=version)
+	parser.add_option("-j", "--jobs", dest="jobs", type="int", default=os.cpu_count() or 1,
+	                  help="number of files scanned in parallel [default: %default]")
+	parser.add_option("-e", "--extensions", dest="extensions", default="tex,bib",
+	                  help="comma-separated extensions of the files scanned in directories [default: %default]")
+	parser.add_option("-q", "--quiet", dest="quiet", action="store_true", default=False,
+	                  help="only report the files with non-ASCII characters")
 	(opts, args) = parser.parse_args()
 
 	# check if console understands Unicode: unix or Windows; latter can be set with chcp 65001; chcp returns current code page
@@ -61,23 +124,27 @@ def main(argv):
 
 
 	# allow for shell expansion
-	for arg in args:
-		for file in glob.glob(arg):
-			if os.path.isfile(file):
-				with open(file,"r",encoding="utf-8") as f:
-					print("Scanning {} for Unicode".format(file))
-					try:
-						body = f.read()
-					except UnicodeDecodeError as E:
-						print(">Problem with Unicode while reading in the file")
-						if (E.reason == 'invalid start byte' or E.reason == 'invalid continuation byte'):
-							print('>> looks like {} at location {}'.format(E.reason,E.start))
-							print('>> The hundred prior characters:')
-							print(E.object[E.start-101:E.start-1])
-							return
-					scan8(body)
-			else:
-				print("Skipping non-text file {}".format(file))
+	(files, skipped) = findFiles(args, opts.extensions.split(','))
+	for file in skipped:
+		print("Skipping non-text file {}".format(file))
+	if opts.jobs > 1 and len(files) > 1:
+		pool = multiprocessing.Pool(min(opts.jobs, len(files)))
+		results = pool.imap(scanFile, files, chunksize=max(1, min(64, len(files)//(4*opts.jobs))))
+	else:
+		pool = None
+		results = map(scanFile, files)
+	try:
+		for (file, report) in results: # in the order of the files
+			if report or not opts.quiet:
+				print("Scanning {} for Unicode".format(file))
+			if report:
+				print('\n'.join(report))
+			elif not opts.quiet:
+				print("No Unicode characters (x80-xFF) found")	
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
 
 
 if __name__ == "__main__":
@@ -2,23 +2,337 @@ import re
 import os
 import string
 import glob
+import collections
+import json
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
 
 
 def get_cmd_matchstr(cmd):
 	return '('+cmd.replace('\\','\\\\')+')'+'[^a-zA-Z]' # this would miss a macro with a non-alpha character (e.g. @)
 
 
-def find_all_deps(cmddefs,cmd,used):
-	cmd_match = '(\\\\[a-zA-Z]*)'
-	m = re.findall(cmd_match,cmddefs[cmd])
-	if m:
-		for ctmp in m:
-			if not ctmp or ctmp==cmd:
+# A control sequence of letters, followed by some non-letter: what get_cmd_matchstr matches, for every such command at once.
+# The greedy letter run cannot stop early, as a shorter run is followed by a letter.
+cs_token = re.compile(r'\\[a-zA-Z]+(?=[^a-zA-Z])')
+plain_cmd = re.compile(r'\\[a-zA-Z]+\Z')
+
+
+def count_control_sequences(text, counts=None):
+	"""Count the control sequences in a text in a single scan, with the same numbers as re.findall(get_cmd_matchstr(cmd), text)
+	gives for each of them: that match takes the character after the command with it, so of two adjacent occurrences of the same
+	command (\\foo\\foo) only the first is counted.
+
+	:param text: the text to scan
+	:param counts: Counter to add to (default: a new one)
+	:return: the Counter, by command name including the backslash
+	"""
+	if counts is None:
+		counts = collections.Counter()
+	next_start = {}
+	for m in cs_token.finditer(text):
+		name = m.group()
+		if m.start() < next_start.get(name, 0):
+			continue
+		counts[name] += 1
+		next_start[name] = m.end()+1
+	return counts
+
+
+def count_matches(cmd, texts):
+	"""Count a command in some texts with its own regex: for the commands count_control_sequences does not see, e.g. with an @"""
+	cmd_match = re.compile(get_cmd_matchstr(cmd))
+	return sum(len(cmd_match.findall(text)) for text in texts)
+
+
+dep_token = re.compile(r'(\\[a-zA-Z]*)')
+
+
+def build_dep_graph(cmddefs):
+	"""Build the macro dependency graph: the user-defined commands each definition uses directly
+
+	:param cmddefs: dictionary of command: definition body
+	:return: dictionary of command: list of the commands it uses, in order of first use
+	"""
+	graph = dict()
+	for cmd in cmddefs.keys():
+		deps = []
+		for ctmp in dep_token.findall(cmddefs[cmd]):
+			if ctmp and ctmp!=cmd and ctmp in cmddefs and ctmp not in deps:
+				deps.append(ctmp)
+		graph[cmd] = deps
+	return graph
+
+
+def find_sccs(graph):
+	"""Strongly connected components of the graph (Tarjan's algorithm, without recursion)
+
+	:return: list of components, each a list of commands, every component after all the components it depends on
+	"""
+	index = dict()
+	lowlink = dict()
+	stack = []
+	on_stack = set()
+	sccs = []
+	for root in graph.keys():
+		if root in index:
+			continue
+		work = [(root, 0)]
+		while work:
+			(cmd, i) = work.pop()
+			if i==0:
+				index[cmd] = lowlink[cmd] = len(index)
+				stack.append(cmd)
+				on_stack.add(cmd)
+			elif i<=len(graph[cmd]):
+				lowlink[cmd] = min(lowlink[cmd], lowlink[graph[cmd][i-1]])
+			while i<len(graph[cmd]) and graph[cmd][i] in index:
+				if graph[cmd][i] in on_stack:
+					lowlink[cmd] = min(lowlink[cmd], index[graph[cmd][i]])
+				i += 1
+			if i<len(graph[cmd]):
+				work.append((cmd, i+1))
+				work.append((graph[cmd][i], 0))
 				continue
-			if ctmp in cmddefs.keys():
-				if ctmp not in used:
-					used.append(ctmp)
-				find_all_deps(cmddefs,ctmp,used)
+			if lowlink[cmd]==index[cmd]:
+				scc = []
+				while True:
+					ctmp = stack.pop()
+					on_stack.discard(ctmp)
+					scc.append(ctmp)
+					if ctmp==cmd:
+						break
+				sccs.append(scc)
+	return sccs
+
+
+def dep_closures(graph, sccs=None):
+	"""All the commands each command needs, directly or through other commands, computed once per strongly connected component
+
+	:param graph: the dependency graph, from build_dep_graph
+	:param sccs: its components, from find_sccs, if already known
+	:return: dictionary of command: frozenset of the commands it needs; the members of a cycle need each other, and themselves
+	"""
+	closures = dict()
+	for scc in (sccs if sccs is not None else find_sccs(graph)):
+		members = set(scc)
+		needs = set(members) if len(scc)>1 else set()
+		for cmd in scc:
+			for ctmp in graph[cmd]:
+				if ctmp not in members:
+					needs.add(ctmp)
+					needs |= closures[ctmp]
+		needs = frozenset(needs)
+		for cmd in scc:
+			closures[cmd] = needs
+	return closures
+
+
+def commands_needed(closures, names):
+	"""The user-defined commands needed by some commands, e.g. those used in one section: the commands themselves and all they need"""
+	needed = set()
+	for cmd in names:
+		if cmd in closures:
+			needed.add(cmd)
+			needed |= closures[cmd]
+	return needed
+
+
+def write_graph(filename, graph, closures, cycles, cmdorder, cmds, used, cmdfulldefs):
+	"""Write the dependency graph as DOT (for a .dot or .gv file name) or else as JSON
+
+	:param filename: the output file
+	:param graph: the dependency graph, from build_dep_graph
+	:param closures: the commands each command needs, from dep_closures
+	:param cycles: the cycles, as lists of commands
+	:param cmdorder: the commands, in order of definition
+	:param cmds: the number of uses in the main text, by command
+	:param used: the commands used, in the text or by other used commands
+	:param cmdfulldefs: the full definition of each command
+	"""
+	with open(filename, 'w') as out:
+		if os.path.splitext(filename)[1].lower() in ('.dot', '.gv'):
+			quote = lambda cmd: '"' + cmd.replace('\\', '\\\\').replace('"', '\\"') + '"'
+			out.write('digraph macros {\n\tnode [shape=box];\n')
+			for cmd in cmdorder:
+				style = ' [style=filled, fillcolor=lightblue]' if cmds[cmd]>0 else ' [style=filled, fillcolor=lightgrey]' if cmd in used else ''
+				out.write('\t{}{};\n'.format(quote(cmd), style))
+			for cmd in cmdorder:
+				for ctmp in graph[cmd]:
+					out.write('\t{} -> {};\n'.format(quote(cmd), quote(ctmp)))
+			out.write('}\n')
+		else:
+			json.dump({'commands': [{'name': cmd, 'deps': graph[cmd], 'needs': [c for c in cmdorder if c in closures[cmd]],
+			                         'count': cmds[cmd], 'used': cmd in used, 'definition': cmdfulldefs[cmd]} for cmd in cmdorder],
+			           'cycles': cycles}, out, indent=1)
+
+
+tex_input = re.compile(r'\\(input|include|subfile)\s*\{([^}]+)\}|\\(input)\s+([^\s{}\\%]+)')
+latexmkrc_texinputs = re.compile(r"\$ENV\{\s*'TEXINPUTS'\s*\}\s*=\s*'([^']*)'")
+
+
+def in_comment(text, pos):
+	"""True if the position in a TeX text is in a comment: after an unescaped % on its line"""
+	line = text[text.rfind('\n', 0, pos)+1:pos]
+	return re.search(r'(?<!\\)(?:\\\\)*%', line) is not None
+
+
+def tex_search_path(root, latexmkrc=None):
+	"""The directories TeX searches for input files: the document directory, then the TEXINPUTS set in latexmkrc and in the
+	environment. The default (system) directories, the empty entries, are left out.
+
+	:param root: the directory of the driver file, in which TeX runs
+	:param latexmkrc: the latexmkrc file (default: the one in root, if any)
+	:return: list of (directory, True if its subdirectories are searched as well, as for a path ending in //)
+	"""
+	entries = []
+	if latexmkrc is None:
+		latexmkrc = os.path.join(root, 'latexmkrc')
+	if os.path.isfile(latexmkrc):
+		with open(latexmkrc) as rc:
+			for m in latexmkrc_texinputs.finditer(rc.read()):
+				entries += m.group(1).split(':')
+	entries += os.environ.get('TEXINPUTS', '').split(os.pathsep)
+	path = [(root, False)]
+	for entry in entries:
+		if not entry:
+			continue
+		recursive = entry.endswith('//')
+		path.append((os.path.normpath(os.path.join(root, entry.rstrip('/') or '/')), recursive))
+	return path
+
+
+def resolve_input(name, path, current_dir, subdirs):
+	"""Find an input file as TeX would: name.tex first, then name, in the directory of the including file, then along the search path
+
+	:param name: the name given to \\input, \\include or \\subfile
+	:param path: the search path, from tex_search_path
+	:param current_dir: the directory of the including file
+	:param subdirs: cache of the subdirectories of the recursive search path entries
+	:return: the file name, or None if not found
+	"""
+	names = [name] if name.endswith('.tex') else [name + '.tex', name]
+	dirs = [path[0][0], current_dir]
+	for (directory, recursive) in path[1:]:
+		if recursive:
+			if directory not in subdirs:
+				subdirs[directory] = [root for (root, dirnames, files) in os.walk(directory)]
+			dirs += subdirs[directory]
+		else:
+			dirs.append(directory)
+	for directory in dirs:
+		for candidate in names:
+			filename = os.path.join(directory, candidate)
+			if os.path.isfile(filename):
+				return os.path.normpath(filename)
+	return None
+
+
+def read_tree(drivers, path, stop='', cache=None):
+	"""Read a document tree, following \\input, \\include and \\subfile from the driver files, each file once
+
+	:param drivers: the driver files
+	:param path: the search path, from tex_search_path
+	:param stop: definitions are only recognized before this string, and in the files input before it
+	:param cache: dictionary of file name: text, shared between calls
+	:return: list of (file name, text, end of the part in which definitions are recognized), in the order TeX reads them
+	"""
+	if cache is None:
+		cache = dict()
+	files = []
+	seen = set()
+	subdirs = dict()
+
+	def visit(texfile, past_stop):
+		texfile = os.path.normpath(texfile)
+		if texfile in seen:
+			return
+		seen.add(texfile)
+		if texfile not in cache:
+			with open(texfile) as tex:
+				cache[texfile] = tex.read()
+		text = cache[texfile]
+		stop_index = text.find(stop) if stop and not past_stop else -1
+		files.append((texfile, text, 0 if past_stop else stop_index if stop_index>=0 else len(text)))
+		for m in tex_input.finditer(text):
+			if in_comment(text, m.start()):
+				continue
+			name = (m.group(2) or m.group(4)).strip()
+			filename = resolve_input(name, path, os.path.dirname(texfile), subdirs)
+			if filename is None:
+				print("Warning: could not find {} (input in {})".format(name, texfile))
+				continue
+			visit(filename, past_stop or 0<=stop_index<m.start())
+
+	for driver in drivers:
+		visit(driver, False)
+	return files
+
+
+def group_end(text, brace):
+	"""The end of a brace group: the position after the brace matching the one at brace, or -1 if it is not closed"""
+	depth = 0
+	pos = brace
+	while pos<len(text):
+		if text[pos]=='\\':
+			pos += 1
+		elif text[pos]=='{':
+			depth += 1
+		elif text[pos]=='}':
+			depth -= 1
+			if depth==0:
+				return pos+1
+		pos += 1
+	return -1
+
+
+def prune_definitions(text, spans):
+	"""Remove definitions from a text, with the rest of their lines if nothing but white space and a comment is left there
+
+	:param text: the text of the definitions file
+	:param spans: the (start, end) of the definitions to remove
+	:return: the pruned text
+	"""
+	pieces = []
+	pos = 0
+	for (start, end) in sorted(spans):
+		line_start = text.rfind('\n', 0, start)+1
+		line_end = text.find('\n', end)
+		line_end = len(text) if line_end<0 else line_end+1
+		if text[line_start:start].strip()=='' and re.match(r'\s*(?:%.*)?\Z', text[end:line_end].rstrip('\n')):
+			(start, end) = (line_start, line_end)
+		pieces.append(text[pos:max(pos, start)])
+		pos = max(pos, end)
+	pieces.append(text[pos:])
+	return ''.join(pieces)
+
+
+def time_compile(driver, compiler, texinputs, repeat=1):
+	"""Compile a document, into a scratch directory, and time it
+
+	:param driver: the driver file, compiled in its own directory
+	:param compiler: the compile command, to which -output-directory and the driver are added
+	:param texinputs: the TEXINPUTS for the compile
+	:param repeat: the number of compiles, of which the fastest counts
+	:return: (the shortest wall time in seconds, the exit status of the last compile)
+	"""
+	outdir = tempfile.mkdtemp(prefix='matchTeX_')
+	env = dict(os.environ, TEXINPUTS=texinputs)
+	cmd = shlex.split(compiler) + ['-output-directory='+outdir, os.path.basename(driver)]
+	best = None
+	try:
+		for i in range(repeat):
+			start = time.perf_counter()
+			status = subprocess.call(cmd, cwd=os.path.dirname(driver) or os.curdir, env=env, stdin=subprocess.DEVNULL,
+			                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+			elapsed = time.perf_counter()-start
+			best = elapsed if best is None else min(best, elapsed)
+	finally:
+		shutil.rmtree(outdir, ignore_errors=True)
+	return (best, status)
 
 
 def main():
@@ -28,7 +342,21 @@ def main():
 	parser.add_argument("texfiles", help="names of TeX files to check", type=str, nargs="+")
 	parser.add_argument("--verbose", help="verbose printout", action='store_true', required=False, default=False)
 	parser.add_argument("--stop", type=str, default="cmsNoteHeader", help='stop recognizing commands after first line matching this string (to disable, use --stop "")')
+	parser.add_argument("--graph", type=str, default=None, help='write the macro dependency graph to this file: DOT for a .dot or .gv file, JSON otherwise')
+	parser.add_argument("--tree", help="treat the TeX files as drivers, and analyze the whole document: all the files they \\input, \\include or \\subfile, recursively", action='store_true', default=False)
+	parser.add_argument("--latexmkrc", type=str, default=None, help='latexmkrc setting the TEXINPUTS for --tree and --time (default: latexmkrc next to the first driver)')
+	parser.add_argument("--prune", type=str, default=None, metavar="FILE", help='write a copy of this definitions file (one of the files checked) with only the definitions of the commands used, and of those they need')
+	parser.add_argument("--output", type=str, default=None, help='file for the pruned definitions (default: FILE_pruned, next to FILE)')
+	parser.add_argument("--in-place", dest="in_place", help="rewrite the definitions file itself", action='store_true', default=False)
+	parser.add_argument("--dry-run", dest="dry_run", help="only list the definitions --prune would remove", action='store_true', default=False)
+	parser.add_argument("--time", type=str, default=None, metavar="DRIVER", help='compile this document with the original and with the pruned definitions, and compare the compile times')
+	parser.add_argument("--compiler", type=str, default="pdflatex -interaction=batchmode -halt-on-error", help='compile command for --time (default: %(default)s)')
+	parser.add_argument("--repeat", type=int, default=3, help='number of compiles for --time, of which the fastest counts (default: %(default)s)')
 	args = parser.parse_args()
+	if args.prune is None and (args.output or args.in_place or args.dry_run or args.time):
+		parser.error("--output, --in-place, --dry-run and --time need --prune")
+	if args.output and args.in_place:
+		parser.error("--output and --in-place exclude each other")
 	texfiles = args.texfiles
 	verbose = args.verbose
 
@@ -40,24 +368,53 @@ def main():
 	cmds = dict()
 	cmddefs = dict()
 	cmdfulldefs = dict()
-	# first pass: find command definitions
-	for texfile in texfiles:
-		with open(texfile) as tex:
-			body = tex.read()
-			# restrict first pass if requested
-			body1 = body
-			if len(args.stop)>0:
-				stop_index = body.find(args.stop)
-				if stop_index<0:
-					print("Warning: requested stop string {} not found, will search entire file".format(args.stop))
-				else:
-					body1 = body[:stop_index]
-			m = p.findall(body1)
-			for c in m:
-				if c[0] is not None and c[0]!='' and c[1] is not None and c[1]!='' and c[1] not in cmdorder:
+	# read the files, and find the part of each in which definitions are recognized
+	if args.tree:
+		tree = read_tree(texfiles, tex_search_path(os.path.dirname(texfiles[0]) or os.curdir, args.latexmkrc), args.stop)
+		if len(args.stop)>0 and not any(args.stop in body for (texfile, body, defs_end) in tree):
+			print("Warning: requested stop string {} not found, will search entire files".format(args.stop))
+		if verbose:
+			print("----------------\nFiles in the document tree:\n----------------")
+			for (texfile, body, defs_end) in tree:
+				print(texfile)
+		sources = [(texfile, body, body[:defs_end]) for (texfile, body, defs_end) in tree]
+	else:
+		sources = []
+		for texfile in texfiles:
+			with open(texfile) as tex:
+				body = tex.read()
+				# restrict the search for definitions if requested
+				body1 = body
+				if len(args.stop)>0:
+					stop_index = body.find(args.stop)
+					if stop_index<0:
+						print("Warning: requested stop string {} not found, will search entire file".format(args.stop))
+					else:
+						body1 = body[:stop_index]
+				sources.append((texfile, body, body1))
+	# single pass: find command definitions, and count the control sequences of the whole text
+	bodies = []
+	counts = collections.Counter()
+	prune_source = None
+	defspans = collections.defaultdict(list) # every definition of a command in the file to prune, redefinitions included
+	for (texfile, body, body1) in sources:
+		bodies.append(body)
+		is_prune = args.prune is not None and prune_source is None and os.path.abspath(texfile)==os.path.abspath(args.prune)
+		if is_prune:
+			prune_source = body
+		for m in p.finditer(body1):
+			c = m.groups()
+			if c[0] is not None and c[0]!='' and c[1] is not None and c[1]!='':
+				if is_prune:
+					# the greedy body pattern may run into the braces around the definition: it ends with its own group
+					defspans[c[1]].append((m.start(1), m.end(1), group_end(body1, m.start(3)-1)))
+				if c[1] not in cmdorder:
 					cmdorder.append(c[1])
 					cmddefs[c[1]] = c[2]
 					cmdfulldefs[c[1]] = c[0]
+		count_control_sequences(body, counts)
+	if args.prune is not None and prune_source is None:
+		parser.error('{} is not one of the files checked'.format(args.prune))
 
 	cmdorder.reverse()
 
@@ -65,41 +422,37 @@ def main():
 	# D=1 for its declaration
 	# + N number of times it is used in nested commands
 	# + M number of times it is used in the main text.
-	# When we make the second pass later, the count will include all of the above.
+	# The counts of the whole text include all of the above.
 	# What we are actually interested is only M though,
 	# so we subtract (1+N) here.
+	defcounts = collections.Counter()
+	for cc in cmddefs.keys():
+		count_control_sequences(cmddefs[cc], defcounts) # N = sum_file (N_file)
+
+	used = set()
 	for cmd in cmdorder:
-		neg_count = 1 # D
-		cmd_match = get_cmd_matchstr(cmd)
-		for cc in cmddefs.keys():
-			m = re.findall(cmd_match,cmddefs[cc])
-			if m:
-				neg_count += len(m) # N = sum_file (N_file)
-		cmds[cmd] = -neg_count # Subtract!
-
-	# second pass: find usage
-	used = []
-	for cmd in cmdorder:
-		for texfile in texfiles:
-			with open(texfile) as tex:
-				body = tex.read()
-				cmd_match = get_cmd_matchstr(cmd)
-				m = re.findall(cmd_match,body)
-				if m:
-					cmds[cmd] += len(m) # Simply add!
+		if plain_cmd.match(cmd):
+			cmds[cmd] = counts[cmd] - 1 - defcounts[cmd]
+		else:
+			cmds[cmd] = count_matches(cmd, bodies) - 1 - count_matches(cmd, cmddefs.values())
 		if cmds[cmd]<0:
 			raise RuntimeError('{} count is {}<0.'.format(cmd,cmds[cmd]))
 		elif cmds[cmd]>0:
-			used.append(cmd)
+			used.add(cmd)
 
-   # This is where it becomes useful to have reversed cmdorder.
-	for i in range(len(cmdorder)):
-		cmd = cmdorder[i]
-		if cmd not in used:
-			continue
-		find_all_deps(cmddefs,cmd,used)
+	# the commands used in other used commands, however deeply nested: the dependency graph is built once,
+	# and the closure computed once per group of mutually recursive definitions
+	graph = build_dep_graph(cmddefs)
+	sccs = find_sccs(graph)
+	cycles = [sorted(scc, key=cmdorder.index, reverse=True) for scc in sccs if len(scc)>1] # in order of definition
+	for cycle in cycles:
+		print("Warning: mutually recursive definitions: {}".format(', '.join(cycle)))
+	closures = dep_closures(graph, sccs)
+	used = commands_needed(closures, used)
 
 	cmdorder.reverse()
+	if args.graph:
+		write_graph(args.graph, graph, closures, cycles, cmdorder, cmds, used, cmdfulldefs)
 
 	if verbose:
 		used_in_text = [cmd for cmd in cmdorder if cmds[cmd]>0]
@@ -122,6 +475,60 @@ def main():
 		for  u in [cmd for cmd in cmdorder if cmd in used]:
 			print(cmdfulldefs[u])
 
+	if args.prune is not None:
+		# the definitions of unused commands; a match holding more than one definition (one line defining several commands) is kept
+		remove = []
+		for cmd in cmdorder:
+			if cmd in used:
+				continue
+			for (start, match_end, end) in defspans[cmd]:
+				if len(re.findall(match_prefix, prune_source[start:match_end]))>1:
+					print("Warning: not pruning {}, defined on a line with other definitions".format(cmd))
+				elif end<0 or end>match_end:
+					print("Warning: not pruning {}, its definition has unbalanced braces".format(cmd))
+				else:
+					remove.append((start, end))
+		pruned = prune_definitions(prune_source, remove)
+		print("----------------\nPruning {}:\n----------------".format(args.prune))
+		if args.dry_run or verbose:
+			for (start, end) in sorted(remove):
+				print(prune_source[start:end])
+			print("----------------")
+		print("{} of {} definitions removed, {} -> {} lines, {} -> {} bytes".format(len(remove), sum(len(spans) for spans in defspans.values()),
+		      prune_source.count('\n'), pruned.count('\n'), len(prune_source), len(pruned)))
+		if args.time:
+			# the pruned copy is put in front of the search path, so that the document is compiled where it is: under its own name,
+			# for \usepackage and \input by name, and under its path from the document directory, for \input by path
+			driver = os.path.abspath(args.time)
+			root = os.path.dirname(driver)
+			texinputs = [directory + ('//' if recursive else '') for (directory, recursive) in tex_search_path(root, args.latexmkrc)[1:]]
+			pruned_dir = tempfile.mkdtemp(prefix='matchTeX_')
+			try:
+				for name in set([os.path.basename(args.prune), os.path.relpath(os.path.abspath(args.prune), root)]):
+					if name.startswith(os.pardir):
+						continue
+					if os.path.dirname(name):
+						os.makedirs(os.path.join(pruned_dir, os.path.dirname(name)), exist_ok=True)
+					with open(os.path.join(pruned_dir, name), 'w') as out:
+						out.write(pruned)
+				times = []
+				for (label, path) in (('original', [os.curdir]), ('pruned', [pruned_dir, os.curdir])):
+					(elapsed, status) = time_compile(driver, args.compiler, os.pathsep.join(path + texinputs + ['']), args.repeat)
+					if status!=0:
+						print("Warning: compiling {} with the {} definitions failed (exit status {})".format(args.time, label, status))
+					times.append(elapsed)
+			finally:
+				shutil.rmtree(pruned_dir, ignore_errors=True)
+			print("Compile time of {}: {:.2f} s original, {:.2f} s pruned ({:+.1%}), fastest of {}".format(args.time, times[0], times[1],
+			      times[1]/times[0]-1, args.repeat))
+		if not args.dry_run:
+			output = args.prune if args.in_place else args.output or '{0}_pruned{1}'.format(*os.path.splitext(args.prune))
+			with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(output)), delete=False) as out:
+				out.write(pruned)
+			shutil.copymode(args.prune, out.name)
+			os.replace(out.name, output)
+			print("Pruned definitions written to {}".format(output))
+
 
 if __name__ == "__main__":
 	main()
@@ -22,6 +22,13 @@ import argparse
 import time, datetime, pytz, datetime
 import sys
 import urllib
+import hashlib
+import re
+import collections
+import html
+import signal
+import json
+import contextlib
 
 
 
@@ -32,6 +39,1004 @@ import urllib
 
 # %%
 
+_texInput = re.compile(r'^([ \t]*)\\(input|include)\s*\{([^}]+)\}', re.MULTILINE) # at the start of a line only, so not commented out
+_texSection = re.compile(r'^[ \t]*\\section\*?\s*[\[{]', re.MULTILINE)
+
+
+def inputText(export, name):
+    """ The text of a file input by a document, or None if it is not found
+
+    :param export: the directory the document is in
+    :param name: the name given to \\input or \\include
+    """
+    target = export / name.strip()
+    if not target.exists():
+        target = target.with_name(target.name + '.tex')
+    if not target.is_file():
+        return None
+    return target.read_text(encoding='latin-1') # bytes through unchanged, whatever the encoding
+
+
+def texUnits(text, export):
+    """ Split a TeX document into units, for diffing them separately: the files its body inputs or includes or, if there are none, its sections
+
+    :param text: the document
+    :param export: the directory the document is in, against which input file names are resolved
+    :return: (mode, labels, skeleton, units, preamble): mode is 'input' or 'section'; labels identify the units (the file names or section
+             numbers); skeleton(names) gives the document with each unit replaced by an input of the file of the given name; units are the
+             unit texts; preamble are the texts of the files input in the preamble, which stay in the skeleton. None if the document has neither.
+    """
+    begin = text.find('\\begin{document}')
+    end = text.rfind('\\end{document}')
+    # only the body is split: latexdiff would mark up a file input in the preamble as text, before the \\DIF commands are defined
+    inputs = list(_texInput.finditer(text, begin if begin >= 0 else 0, end if end >= 0 else len(text)))
+    preamble = [inputText(export, m.group(3)) for m in _texInput.finditer(text, 0, begin if begin >= 0 else 0)]
+    if inputs:
+        units = [inputText(export, m.group(3)) for m in inputs]
+        if None in units:
+            return None
+        def skeleton(names):
+            parts = []
+            p = 0
+            for (m, name) in zip(inputs, names):
+                parts.append(text[p:m.start(0)] + '{}\\{}{{{}}}'.format(m.group(1), m.group(2), name))
+                p = m.end(0)
+            return ''.join(parts) + text[p:]
+        return ('input', [m.group(3).strip() for m in inputs], skeleton, units, preamble)
+    starts = [m.start(0) for m in _texSection.finditer(text, begin if begin >= 0 else 0, end if end >= 0 else len(text))]
+    if begin < 0 or end < 0 or not starts:
+        return None
+    bounds = starts + [end]
+    units = [text[a:b] for (a, b) in zip(bounds[:-1], bounds[1:])]
+    def skeleton(names):
+        return text[:starts[0]] + ''.join('\\input{{{}}}\n'.format(name) for name in names) + text[end:]
+    return ('section', list(range(len(units))), skeleton, units, preamble)
+
+
+def writeFresh(path, text):
+    """ Write a file as a new inode, so a hardlinked (cached, read-only) file of the same name is never written through """
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+    path.write_text(text, encoding='latin-1')
+
+
+def linkFile(src, dst):
+    """ Hardlink a file, or symlink it where hardlinks are not possible (e.g. across file systems): never a copy """
+    try:
+        os.link(str(src), str(dst))
+    except OSError:
+        os.symlink(str(Path(src).absolute()), str(dst))
+
+
+def stageTree(preferred, other, dest):
+    """ Merge two export trees with links: every file of the preferred tree, and the files only the other tree has
+
+    :param preferred: the tree whose files are taken where both have one
+    :param other: the other tree
+    :param dest: the merged tree to create
+    :return: the number of files linked from each tree, as (preferred, other)
+    """
+    counts = [0, 0]
+    for (n, tree) in enumerate((Path(preferred), Path(other))):
+        for (root, dirs, files) in os.walk(str(tree)):
+            rel = Path(root).relative_to(tree)
+            (dest/rel).mkdir(parents=True, exist_ok=True)
+            for name in files:
+                target = dest/rel/name
+                if os.path.lexists(str(target)):
+                    continue
+                if os.path.islink(os.path.join(root, name)):
+                    os.symlink(os.readlink(os.path.join(root, name)), str(target))
+                else:
+                    linkFile(Path(root)/name, target)
+                counts[n] += 1
+    return tuple(counts)
+
+
+def sameContent(a, b):
+    """ True if two files have the same content: the same inode, or the same size and hash """
+    (sa, sb) = (os.stat(str(a)), os.stat(str(b)))
+    if (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino):
+        return True
+    if sa.st_size != sb.st_size:
+        return False
+    digests = []
+    for path in (a, b):
+        h = hashlib.sha256()
+        with open(str(path), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digests.append(h.digest())
+    return digests[0] == digests[1]
+
+
+def figureChanges(old, new):
+    """ The figures that differ between two export trees
+
+    :return: (changed, added, removed), sorted lists of paths relative to the trees
+    """
+    figures = []
+    for tree in (Path(old), Path(new)):
+        figures.append(set(str(path.relative_to(tree)) for path in tree.rglob('*') if path.suffix.lower() in repoMirror.figureTypes and path.is_file()))
+    changed = sorted(name for name in figures[0] & figures[1] if not sameContent(Path(old)/name, Path(new)/name))
+    return (changed, sorted(figures[1] - figures[0]), sorted(figures[0] - figures[1]))
+
+
+_markFigures = r"""%% tdrDiff: frame the figures that changed between the revisions
+\RequirePackage{color}
+\makeatletter
+\newcommand{\tdrDiffMarked}[1]{\@ifnextchar[{\tdrDiffMarkedOpt{#1}}{\tdrDiffMarkedOpt{#1}[]}}
+\def\tdrDiffMarkedOpt#1[#2]#3{\ifcsname tdrDiffChanged@#3\endcsname\fcolorbox{red}{white}{#1[#2]{#3}}\else#1[#2]{#3}\fi}
+\AtBeginDocument{\let\tdrDiffIncludegraphics\includegraphics
+  \renewcommand{\includegraphics}{\@ifstar{\tdrDiffMarked{\tdrDiffIncludegraphics*}}{\tdrDiffMarked{\tdrDiffIncludegraphics}}}}
+%s
+\makeatother
+"""
+
+
+def markFigures(diffile, figures):
+    r""" Frame the given figures in a diff document, wherever it includes them with \includegraphics, under any of the names they
+        can be given by: with or without the directory and the extension
+
+    :param diffile: the diff document, with the preamble
+    :param figures: paths of the figures
+    :return: True if the document could be marked up
+    """
+    text = Path(diffile).read_text(encoding='latin-1')
+    begin = text.find('\\begin{document}')
+    if begin < 0:
+        return False
+    names = set()
+    for figure in figures:
+        (stem, ext) = os.path.splitext(figure)
+        for name in (stem, os.path.basename(stem)):
+            names.update((name, name + ext))
+    defs = '\n'.join('\\@namedef{tdrDiffChanged@%s}{}' % name for name in sorted(names))
+    writeFresh(diffile, text[:begin] + _markFigures % defs + text[begin:])
+    return True
+
+
+class timingTrace(object):
+    """
+    timingTrace: wall and CPU times of the phases of a run and of its commands, with their exit status and output size,
+    summed up by phase and command or written as a Chrome trace (chrome://tracing, Perfetto), one lane per parallel command.
+    """
+
+    def __init__(self, origin=None):
+        """
+        :arg origin: the start time of the run, as from time.time(); default: now
+        """
+        self._origin = origin or time.time()
+        self.events = []
+        self._lanes = {0: 'tdrDiff'}
+
+    @staticmethod
+    def cpu():
+        """ CPU time used so far, user plus system, by this process and by its finished child processes """
+        try:
+            import resource # Unix only
+        except ImportError:
+            t = os.times()
+            return t.user + t.system + t.children_user + t.children_system
+        (me, children) = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        return me.ru_utime + me.ru_stime + children.ru_utime + children.ru_stime
+
+    @staticmethod
+    def outputSize(out):
+        """ Size in bytes of a command output: captured bytes, or the file written to """
+        if isinstance(out, bytes):
+            return len(out)
+        try:
+            return os.fstat(out.fileno()).st_size
+        except (AttributeError, ValueError, OSError):
+            try:
+                return os.path.getsize(str(out))
+            except (TypeError, OSError):
+                return None
+
+    def add(self, name, cat, start, wall, key=None, lane=0, **args):
+        """ Record an event
+
+        :param name: the name shown in the trace
+        :param cat: its category: phase, command or job
+        :param start: start time, as from time.time()
+        :param wall: wall time in seconds
+        :param key: what the summary adds it up under, default the name
+        :param lane: the trace lane (thread) to show it on
+        :param args: further values: cpu (seconds), code (exit status), output (bytes), ...
+        """
+        self.events.append({'name': name, 'cat': cat, 'key': key or name, 'start': start, 'wall': wall, 'lane': lane, 'args': args})
+
+    def lane(self, lane, name):
+        """ Name a trace lane """
+        self._lanes.setdefault(lane, name)
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        """ Time the block of a with statement as a phase """
+        (t0, c0) = (time.time(), timingTrace.cpu())
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = type(e).__name__
+            raise
+        finally:
+            self.add(name, 'phase', t0, time.time() - t0, cpu=timingTrace.cpu() - c0, **args)
+
+    def run(self, cmd, key=None, **kwargs):
+        """ subprocess.run, timed as a command
+
+        :param cmd: the command, as a list
+        :param key: the summary key, default the program name
+        :param kwargs: passed to subprocess.run
+        :return: the CompletedProcess
+        """
+        (t0, c0, code) = (time.time(), timingTrace.cpu(), None)
+        proc = None
+        try:
+            proc = subprocess.run(cmd, **kwargs)
+            code = proc.returncode
+            return proc
+        except subprocess.CalledProcessError as e:
+            code = e.returncode
+            raise
+        finally:
+            out = proc.stdout if proc is not None and proc.stdout is not None else kwargs.get('stdout')
+            self.add(' '.join(str(c) for c in cmd)[:200], 'command', t0, time.time() - t0, key=key or Path(str(cmd[0])).name,
+                     cpu=timingTrace.cpu() - c0, code=code, output=timingTrace.outputSize(out))
+
+    def chrome(self):
+        """ The events in the Chrome trace event format """
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': lane, 'args': {'name': name}} for (lane, name) in sorted(self._lanes.items())]
+        for e in sorted(self.events, key=lambda e: (e['start'], -e['wall'])):
+            events.append({'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'pid': pid, 'tid': e['lane'],
+                           'ts': round((e['start'] - self._origin) * 1e6), 'dur': round(e['wall'] * 1e6),
+                           'args': dict((k, v) for (k, v) in e['args'].items() if v is not None)})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, filename):
+        """ Write the Chrome trace to a file """
+        with open(filename, 'w') as f:
+            json.dump(self.chrome(), f, indent=0)
+
+    def summary(self):
+        """ A table of the phases, then of the commands by program, with their count, total wall and CPU times, failures and output """
+        rows = collections.OrderedDict()
+        for e in self.events:
+            row = rows.setdefault((e['cat'] in ('command', 'job'), e['key']), [0, 0., 0., 0, 0])
+            row[0] += 1
+            row[1] += e['wall']
+            row[2] += e['args'].get('cpu') or 0.
+            row[3] += 1 if e['args'].get('code') or e['args'].get('error') else 0
+            row[4] += e['args'].get('output') or 0
+        lines = ['{:<28} {:>5} {:>9} {:>9} {:>5} {:>10}'.format('phase / command', 'runs', 'wall [s]', 'cpu [s]', 'fail', 'output')]
+        for ((isCommand, key), (n, wall, cpu, failed, output)) in sorted(rows.items(), key=lambda r: (r[0][0], -r[1][1])):
+            lines.append('{:<28} {:>5} {:>9.2f} {:>9.2f} {:>5} {:>10}'.format(('  ' if isCommand else '') + key[:26], n, wall, cpu, failed or '',
+                                                                        '{:.1f} kB'.format(output / 1024.) if output else ''))
+        return '\n'.join(lines)
+
+
+class repoMirror(object):
+    """
+    repoMirror: a bare mirror of a git repository in a cache directory, fetched incrementally, with submodule mirrors of its own,
+    from which revisions are checked out as worktrees.
+    A lean mirror (git 2.35 or later) is blobless and shallow, and checks out sparse worktrees without the unused figures.
+    """
+
+    leanGitVersion = (2, 35)
+    figureTypes = ('.pdf', '.png', '.jpg', '.jpeg', '.eps', '.ps', '.gif', '.svg', '.tif', '.tiff')
+    texTypes = ('.tex', '.sty', '.cls') # the files searched for figure names
+    _token = re.compile(r'[\w.][\w./+-]*')
+    _patternSpecial = re.compile(r'([*?[\\!#])|^ | $') # gitignore pattern syntax, escaped in file names
+
+    def __init__(self, url, cacheDir, git='git', logger=None, procout=subprocess.DEVNULL, mirrors=None, trace=None, filter=None, depth=None, sparse=False):
+        """
+        :arg url: the repository URL: any URL git accepts, including file:// URLs and local paths
+        :arg cacheDir: the directory holding the mirrors
+        :arg git: the git executable
+        :arg logger: logger for progress messages
+        :arg procout: where to send the output of git (None to echo it)
+        :arg mirrors: the submodule mirrors already in use, by URL, shared between a mirror and those of its submodules
+        :arg trace: timingTrace recording the git commands
+        :arg filter: partial clone filter of a new mirror, e.g. blob:none
+        :arg depth: history depth of a new mirror; None for the whole history
+        :arg sparse: check out sparse worktrees, without the figures that are not used
+        """
+        self._url = url
+        self._cacheDir = Path(cacheDir)
+        self._git = str(git)
+        self._logger = logger or logging.getLogger(__name__)
+        self._procout = procout
+        name = re.sub(r'[^\w.-]+', '_', url.rstrip('/').split('/')[-1])[:40]
+        self.path = self._cacheDir / '{}-{}.git'.format(name, hashlib.sha1(url.encode('utf-8')).hexdigest()[:12])
+        self._updated = False
+        self._mirrors = {} if mirrors is None else mirrors
+        self._trace = trace or timingTrace()
+        self._filter = filter
+        self._depth = depth
+        self._sparse = sparse
+        self._sparseTrees = set() # the worktrees checked out sparse
+
+    def run(self, *args, cwd=None, stdout=None, stdin=None):
+        """ Run a git command, by default in the mirror
+
+        :param args: the git arguments
+        :param cwd: directory to run in (default: the mirror)
+        :param stdout: where to send the standard output (default: as for the other git output)
+        :param stdin: text for the standard input
+        :return: the CompletedProcess
+        """
+        return self._trace.run([self._git] + list(args), 'git ' + next((a for a in args if not a.startswith('-') and '=' not in a), ''),
+                               cwd=str(cwd or self.path), check=True, stdout=self._procout if stdout is None else stdout, stderr=self._procout,
+                               input=stdin.encode('utf-8') if stdin is not None else None)
+
+    def update(self):
+        """ Create the mirror, or fetch what is new since the last use. Done at most once per instance. """
+        if self._updated:
+            return self
+        self._cacheDir.mkdir(parents=True, exist_ok=True)
+        if (self.path / 'HEAD').exists():
+            self._logger.info('Updating mirror of %s', self._url)
+            self.run('remote', 'update', '--prune')
+            self.run('worktree', 'prune') # forget worktrees whose directories were deleted
+        else:
+            self._logger.info('Creating mirror of %s in %s', self._url, self.path)
+            tmp = Path(tempfile.mkdtemp(prefix=self.path.name + '.', dir=str(self._cacheDir)))
+            try:
+                self.clone(tmp)
+                os.replace(str(tmp), str(self.path)) # only complete mirrors appear under the final name
+            except BaseException:
+                shutil.rmtree(str(tmp), ignore_errors=True)
+                raise
+        if not (self._depth or self._filter):
+            self.complete() # e.g. a lean mirror made for an earlier run
+        self._updated = True
+        return self
+
+    def clone(self, tmp):
+        """ Clone the mirror into tmp: lean if asked for, falling back to a full clone if the server refuses """
+        if self._depth or self._filter:
+            url = self._url
+            if os.path.isabs(url) and os.path.exists(url): # local clones ignore --depth and --filter: go through the git protocol
+                url = Path(url).as_uri()
+            lean = (['--filter=' + self._filter] if self._filter else []) + (['--depth', str(self._depth), '--no-single-branch'] if self._depth else [])
+            try:
+                self.run('clone', '--mirror', *lean, url, str(tmp), cwd=self._cacheDir)
+                self.run('remote', 'set-url', 'origin', self._url, cwd=tmp)
+                return
+            except subprocess.CalledProcessError:
+                self._logger.warning('Could not make a lean clone of %s: cloning the full repository', self._url)
+                shutil.rmtree(str(tmp), ignore_errors=True)
+                tmp.mkdir()
+        self.run('clone', '--mirror', self._url, str(tmp), cwd=self._cacheDir)
+
+    def shallow(self):
+        """ True if the mirror lacks older history """
+        return (self.path / 'shallow').exists()
+
+    def complete(self):
+        """ Fetch the whole history of a shallow mirror, e.g. to list the commits of a range """
+        if self.shallow():
+            self._logger.info('Fetching the full history of %s', self._url)
+            self.run('fetch', '--unshallow', '--update-head-ok', 'origin')
+        return self
+
+    def commit(self, rev):
+        """ Resolve a revision to a commit SHA, deepening a shallow mirror until the commit is in it
+
+        :param rev: anything git rev-parse accepts
+        :return: the SHA
+        :raise subprocess.CalledProcessError: for an unknown revision
+        """
+        self.update()
+        deepen = max(self._depth or 0, 8)
+        while True:
+            try:
+                return self.run('rev-parse', '--verify', '--quiet', rev + '^{commit}', stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+            except subprocess.CalledProcessError:
+                if not self.shallow():
+                    raise
+            if deepen > 1024: # not worth it any more
+                self.complete()
+                continue
+            self._logger.info('%s is not in the fetched history of %s: fetching %d more commits', rev, self._url, deepen)
+            try:
+                self.run('fetch', '--deepen={}'.format(deepen), '--update-head-ok', 'origin')
+                deepen *= 2
+            except subprocess.CalledProcessError:
+                self.complete()
+
+    def worktree(self, rev, path):
+        """ Check out a revision, with its submodules, as a worktree of the mirror
+
+        :param rev: the revision: anything git rev-parse accepts, e.g. HEAD~1 or a SHA
+        :param path: where to put the worktree, which must not exist yet
+        :return: the worktree path
+        """
+        sha = self.commit(rev)
+        path = Path(path).absolute()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if self._sparse:
+            self.run('worktree', 'add', '--detach', '--no-checkout', str(path), sha)
+            if self.sparseCheckout(path, sha):
+                self._sparseTrees.add(path)
+        else:
+            self.run('worktree', 'add', '--detach', str(path), sha)
+        self._logger.debug('Checked out %s of %s in %s', rev, self._url, path)
+        self.updateSubmodules(path)
+        return path
+
+    def sparseCheckout(self, path, sha):
+        """ Check out the files of a --no-checkout worktree but the figures that no text file names. The text files are checked out
+            first, and searched for the figure names. If sparse checkout does not work, everything is checked out.
+
+        :param path: the worktree
+        :param sha: its commit
+        :return: True if the worktree is sparse
+        """
+        proc = self.run('ls-tree', '-r', '-z', '--full-tree', sha, stdout=subprocess.PIPE) # -z: names unquoted
+        (text, figures) = ([], [])
+        for line in proc.stdout.decode('utf-8').split('\0')[:-1]:
+            (info, name) = line.split('\t', 1)
+            if info.split()[0] == '160000': # a submodule
+                text.append(repoMirror.sparsePattern(name) + '/')
+            elif Path(name).suffix.lower() in repoMirror.figureTypes:
+                figures.append(name)
+            else:
+                text.append(name)
+        try:
+            self.run('sparse-checkout', 'set', '--no-cone', '--stdin', cwd=path,
+                     stdin='\n'.join(name if name.endswith('/') else repoMirror.sparsePattern(name) for name in text))
+            self.run('reset', '--quiet', '--hard', sha, cwd=path)
+            names = set()
+            for name in text:
+                file = path / name
+                if file.suffix.lower() in repoMirror.texTypes and file.is_file():
+                    for token in repoMirror._token.findall(file.read_text(encoding='utf-8', errors='replace')):
+                        token = token[2:] if token.startswith('./') else token
+                        names.add(os.path.splitext(token)[0] if os.path.splitext(token)[1].lower() in repoMirror.figureTypes else token)
+            used = [name for name in figures if os.path.splitext(name)[0] in names or os.path.splitext(os.path.basename(name))[0] in names]
+            self._logger.info('Sparse checkout of %s: %d files, %d of %d figures', sha[:12], len(text), len(used), len(figures))
+            if used:
+                self.run('sparse-checkout', 'add', '--stdin', cwd=path, stdin='\n'.join(repoMirror.sparsePattern(name) for name in used))
+            return True
+        except subprocess.CalledProcessError:
+            self._logger.warning('Sparse checkout failed: checking out all files')
+            try:
+                self.run('sparse-checkout', 'disable', cwd=path)
+            except subprocess.CalledProcessError:
+                pass # sparse checkout was never set up
+            self.run('reset', '--quiet', '--hard', sha, cwd=path)
+            return False
+
+    @staticmethod
+    def sparsePattern(name):
+        """ The --no-cone sparse-checkout pattern matching exactly the file name given, relative to the top of the tree """
+        return '/' + repoMirror._patternSpecial.sub(lambda m: '\\' + m.group(0), name)
+
+    def sparse(self, path):
+        """ True if path is a worktree of the mirror checked out sparse """
+        return Path(path).absolute() in self._sparseTrees
+
+    def fullCheckout(self, path):
+        """ Check out the files a sparse worktree left out, e.g. the figures it did not find named in the text files
+
+        :param path: the worktree, checked out sparse
+        """
+        path = Path(path).absolute()
+        self._logger.info('Checking out all the files of %s', path)
+        self.run('sparse-checkout', 'disable', cwd=path)
+        self._sparseTrees.discard(path)
+
+    def updateSubmodules(self, path):
+        """ Check out the submodules of a worktree (recursively), cloning them from their own mirrors
+
+        :param path: the worktree
+        """
+        if not (path / '.gitmodules').exists():
+            return
+        proc = self.run('config', '-f', '.gitmodules', '--get-regexp', r'^submodule\..*\.url$', cwd=path, stdout=subprocess.PIPE)
+        for line in proc.stdout.decode('utf-8').splitlines():
+            (key, url) = line.split(None, 1)
+            name = key[len('submodule.'):-len('.url')]
+            url = self.resolve(url)
+            if url not in self._mirrors: # each submodule is fetched once per run, however many worktrees use it
+                self._mirrors[url] = repoMirror(url, self._cacheDir, self._git, self._logger, self._procout, self._mirrors, self._trace).update()
+            mirror = self._mirrors[url]
+            subPath = self.submodulePath(path, name)
+            self.run('config', 'submodule.{}.url'.format(name), str(mirror.path), cwd=path)
+            self.run('-c', 'protocol.file.allow=always', 'submodule', 'update', '--init', '--', subPath, cwd=path)
+            mirror.updateSubmodules(path / subPath)
+
+    def submodulePath(self, path, name):
+        """ The path of a submodule in a worktree, from .gitmodules """
+        proc = self.run('config', '-f', '.gitmodules', 'submodule.{}.path'.format(name), cwd=path, stdout=subprocess.PIPE)
+        return proc.stdout.decode('utf-8').strip()
+
+    def resolve(self, url):
+        """ Resolve a submodule URL relative to this repository's URL, as git does for ./ and ../ URLs """
+        if not (url.startswith('./') or url.startswith('../')):
+            return url
+        base = self._url.rstrip('/')
+        for part in url.split('/'):
+            if part == '..':
+                base = base.rsplit('/', 1)[0]
+            elif part and part != '.':
+                base = base + '/' + part
+        return base
+
+    def removeWorktree(self, path):
+        """ Remove a worktree made by worktree() """
+        self.run('worktree', 'remove', '--force', str(path))
+
+
+class exportCache(object):
+    """
+    exportCache: cache of tdr --export output directories, keyed by commit SHA and tdr tool and arguments, handed out as hardlinks.
+    Entries modified through a hardlink are detected by their size and mtime manifest and discarded.
+    """
+
+    def __init__(self, cacheDir, maxSize=1024, logger=None):
+        """
+        :arg cacheDir: the directory holding the cached exports
+        :arg maxSize: the size limit of the cache in MB
+        :arg logger: logger for progress messages
+        """
+        self._cacheDir = Path(cacheDir)
+        self._maxSize = maxSize * 2**20
+        self._logger = logger or logging.getLogger(__name__)
+
+    @staticmethod
+    def key(docTag, sha, tool, args):
+        """ The cache key of an export
+
+        :param docTag: the document tag
+        :param sha: the commit SHA of the exported tree
+        :param tool: the tdr executable
+        :param args: the tdr arguments
+        """
+        h = hashlib.sha256(Path(tool).read_bytes())
+        h.update('\0'.join([docTag, sha] + list(args)).encode('utf-8'))
+        return h.hexdigest()
+
+    def fetch(self, key, dest):
+        """ Put a cached export in place
+
+        :param key: the cache key
+        :param dest: the export directory to create, which must not exist yet
+        :return: True on a hit
+        """
+        entry = self._cacheDir / key
+        if not entry.is_dir():
+            return False
+        try:
+            manifest = json.loads((entry/'manifest.json').read_text())
+        except (OSError, ValueError):
+            manifest = None
+        if manifest != exportCache.manifest(entry/'export'):
+            self._logger.warning('Discarding cached export %s: modified since it was stored', key)
+            shutil.rmtree(str(entry), onerror=exportCache.forceRemove)
+            return False
+        os.utime(str(entry)) # most recently used
+        shutil.copytree(str(entry/'export'), str(dest), copy_function=exportCache.link)
+        return True
+
+    @staticmethod
+    def manifest(export):
+        """ The size and mtime of each file of an export, by relative path """
+        files = {}
+        for (root, dirs, names) in os.walk(str(export)):
+            for name in names:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                files[os.path.relpath(path, str(export))] = [st.st_size, st.st_mtime_ns]
+        return files
+
+    @staticmethod
+    def link(src, dst):
+        """ Hardlink a cached file, or copy it (read-only) where hardlinks are not possible """
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+            os.chmod(dst, 0o444)
+
+    def store(self, key, export):
+        """ Add an export to the cache, as a read-only copy, then evict as needed
+
+        :param key: the cache key
+        :param export: the export directory
+        """
+        entry = self._cacheDir / key
+        if entry.is_dir():
+            return
+        self._cacheDir.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix='.tmp', dir=str(self._cacheDir)))
+        try:
+            shutil.copytree(str(export), str(tmp/'export'))
+            for (root, dirs, files) in os.walk(str(tmp/'export')):
+                for name in files:
+                    os.chmod(os.path.join(root, name), 0o444)
+            (tmp/'manifest.json').write_text(json.dumps(exportCache.manifest(tmp/'export')))
+            os.chmod(str(tmp), 0o755) # mkdtemp creates private directories
+            os.replace(str(tmp), str(entry)) # only complete entries appear under the final name
+        finally:
+            shutil.rmtree(str(tmp), ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits its size limit. The newest entry is always kept. """
+        entries = []
+        total = 0
+        for entry in self._cacheDir.iterdir():
+            if entry.name.startswith('.tmp') or not entry.is_dir():
+                continue
+            size = sum(os.lstat(os.path.join(root, name)).st_size for (root, dirs, files) in os.walk(str(entry)) for name in files)
+            entries.append((entry.stat().st_mtime, size, entry))
+            total += size
+        entries.sort()
+        for (mtime, size, entry) in entries[:-1]:
+            if total <= self._maxSize:
+                break
+            self._logger.debug('Evicting cached export %s', entry.name)
+            shutil.rmtree(str(entry), onerror=exportCache.forceRemove)
+            total -= size
+
+    @staticmethod
+    def forceRemove(func, path, excinfo):
+        """ rmtree error handler: make the read-only entry writable and retry """
+        os.chmod(os.path.dirname(path), 0o755)
+        os.chmod(path, 0o644)
+        func(path)
+
+
+class latexmkCache(object):
+    """
+    latexmkCache: persistent latexmk output directories, one per document tag and revision pair, emptied when the class, style,
+    BibTeX or bibliography files they were built from change. Only the most recently used directories of each tag are kept.
+    """
+
+    stampTypes = ('.cls', '.sty', '.bst', '.bib')
+    _rule = re.compile(r"Run number \d+ of rule '([^']*)'")
+
+    def __init__(self, cacheDir, keep=8, logger=None):
+        """
+        :arg cacheDir: the directory holding the build directories, by tag
+        :arg keep: the number of build directories kept for each tag
+        :arg logger: logger for progress messages
+        """
+        self._cacheDir = Path(cacheDir)
+        self._keep = keep
+        self._logger = logger or logging.getLogger(__name__)
+
+    @staticmethod
+    def stamp(srcDir, tool):
+        """ The hash of the files that invalidate a build directory when they change
+
+        :param srcDir: the directory the document is compiled from
+        :param tool: the latexmk executable
+        """
+        h = hashlib.sha256(str(tool).encode('utf-8'))
+        for path in sorted(p for p in Path(srcDir).rglob('*') if p.suffix in latexmkCache.stampTypes and p.is_file()):
+            h.update(str(path.relative_to(srcDir)).encode('utf-8') + b'\0')
+            h.update(path.read_bytes())
+        return h.hexdigest()
+
+    def directory(self, docTag, old, new, stamp):
+        """ The build directory of a revision pair, emptied if its stamp does not match
+
+        :param docTag: the document tag
+        :param old: the older revision: a SHA, or a name such as worktree
+        :param new: the newer revision
+        :param stamp: the stamp of the sources, from stamp()
+        :return: the directory
+        """
+        path = self._cacheDir / docTag / '{}_{}'.format(old[:12], new[:12])
+        stampFile = path / '.tdrDiff-stamp'
+        if path.is_dir() and not (stampFile.exists() and stampFile.read_text() == stamp):
+            self._logger.info('Class, style or bibliography files changed: clearing the latexmk build directory %s', path)
+            shutil.rmtree(str(path))
+        elif path.is_dir():
+            self._logger.debug('Reusing the latexmk build directory %s', path)
+            os.utime(str(path)) # most recently used
+        if not path.is_dir():
+            path.mkdir(parents=True)
+            stampFile.write_text(stamp)
+        self.evict(path.parent)
+        return path
+
+    def evict(self, tagDir):
+        """ Remove the least recently used build directories of a tag beyond the number kept """
+        entries = sorted((entry.stat().st_mtime, entry) for entry in tagDir.iterdir() if entry.is_dir())
+        for (mtime, entry) in entries[:-self._keep]:
+            self._logger.debug('Removing the latexmk build directory %s', entry)
+            shutil.rmtree(str(entry), ignore_errors=True)
+
+    @staticmethod
+    def passes(logfile):
+        """ The runs of each rule (pdflatex, bibtex, ...) in a latexmk log, as a Counter """
+        try:
+            return collections.Counter(m.group(1).split()[0] for m in latexmkCache._rule.finditer(Path(logfile).read_text(errors='replace')))
+        except OSError:
+            return collections.Counter()
+
+    @staticmethod
+    def report(passes):
+        """ The passes from passes(), in words """
+        latex = sum(n for (rule, n) in passes.items() if rule.endswith('latex'))
+        bib = sum(n for (rule, n) in passes.items() if rule in ('bibtex', 'biber'))
+        return '{} LaTeX pass{}, {} BibTeX run{}'.format(latex, '' if latex == 1 else 'es', bib, '' if bib == 1 else 's')
+
+
+class scratchError(Exception):
+    """ The scratch space went over its disk budget """
+    pass
+
+
+class scratchSpace(object):
+    """
+    scratchSpace: the work area of a tdrDiff run, optionally on tmpfs, held to a disk budget and removed on leaving the context,
+    even on SIGINT or SIGTERM, once the files matching the keep patterns are copied out.
+    """
+
+    shm = Path('/dev/shm')
+
+    def __init__(self, prefix='tdrDiff_', tmpfs=False, budget=None, keep=(), keepDir=None, keepAll=False, logger=None, interval=2.):
+        """
+        :arg prefix: prefix of the work area name
+        :arg tmpfs: put the work area on /dev/shm, if it is there and has room
+        :arg budget: the disk budget in MB; None for no limit
+        :arg keep: glob patterns of the files to keep, e.g. *.log or *_diff.tex
+        :arg keepDir: where to copy the kept files
+        :arg keepAll: do not remove the work area at all
+        :arg logger: logger for progress messages
+        :arg interval: minimum time in seconds between two samples of the usage while commands run
+        """
+        self._prefix = prefix
+        self._tmpfs = tmpfs
+        self._budget = budget * 2**20 if budget else None
+        self._keep = list(keep)
+        self._keepDir = Path(keepDir) if keepDir else Path.cwd()/(prefix.rstrip('_') + '_artifacts')
+        self._keepAll = keepAll
+        self._logger = logger or logging.getLogger(__name__)
+        self._interval = interval
+        self.root = None
+        self.written = 0 # bytes in the files seen, each counted once
+        self.peak = 0 # the highest usage seen, in bytes
+        self._seen = set()
+        self._lastCheck = 0.
+
+    def base(self):
+        """ The directory to make the work area in """
+        if self._tmpfs:
+            if self.shm.is_dir() and os.access(str(self.shm), os.W_OK):
+                free = shutil.disk_usage(str(self.shm)).free
+                if free >= (self._budget or 2**29):
+                    return str(self.shm)
+                self._logger.info('Not enough room on %s (%.0f MB free): using the disk', self.shm, free / 2.**20)
+            else:
+                self._logger.info('No tmpfs at %s: using the disk', self.shm)
+        return None # the default temporary directory
+
+    def __enter__(self):
+        self.root = Path(tempfile.mkdtemp(prefix=self._prefix, dir=self.base()))
+        self._logger.info('Scratch space in %s', self.root)
+        self._sigterm = signal.signal(signal.SIGTERM, scratchSpace.terminate)
+        return self
+
+    @staticmethod
+    def terminate(signum, frame):
+        """ SIGTERM handler: unwind as for an interrupt, so that the scratch space is cleaned up """
+        raise KeyboardInterrupt('terminated by signal {}'.format(signum))
+
+    def __exit__(self, excType, exc, tb):
+        signal.signal(signal.SIGTERM, self._sigterm)
+        try:
+            self.check(force=True, enforce=False)
+        except OSError:
+            pass
+        if Path.cwd() == self.root or self.root in Path.cwd().parents:
+            os.chdir(str(self.root.parent)) # do not stay in a directory about to be removed
+        kept = self.keepArtifacts()
+        if excType is not None:
+            self._logger.warning('Cleaning up %s after %s', self.root, excType.__name__)
+        if self._keepAll:
+            self._logger.info('Keeping the scratch space %s', self.root)
+        else:
+            shutil.rmtree(str(self.root), ignore_errors=True)
+        self._logger.info('Scratch space: %.1f MB written, peak usage %.1f MB%s', self.written / 2.**20, self.peak / 2.**20,
+                          '; kept {} files in {}'.format(kept, self._keepDir) if kept else '')
+        return False
+
+    def keepArtifacts(self):
+        """ Copy the files matching the keep patterns out of the work area, keeping their relative paths
+
+        :return: the number of files copied
+        """
+        kept = 0
+        for pattern in self._keep:
+            for path in self.root.rglob(pattern):
+                if path.is_file():
+                    dest = self._keepDir/path.relative_to(self.root)
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(str(path), str(dest))
+                    kept += 1
+        return kept
+
+    def usage(self):
+        """ The bytes in the work area now, counting hardlinked files once; also adds new files to the bytes written """
+        total = 0
+        inodes = set()
+        for (root, dirs, files) in os.walk(str(self.root)):
+            for name in files:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError: # removed meanwhile
+                    continue
+                if (st.st_dev, st.st_ino) in inodes:
+                    continue
+                inodes.add((st.st_dev, st.st_ino))
+                total += st.st_size
+                version = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+                if version not in self._seen:
+                    self._seen.add(version)
+                    self.written += st.st_size
+        return total
+
+    def check(self, force=False, enforce=True):
+        """ Sample the usage, at most once per interval unless forced, and hold it to the budget
+
+        :param force: sample now
+        :param enforce: raise scratchError if the usage is over the budget
+        """
+        if not self.root or (not force and time.time() - self._lastCheck < self._interval):
+            return
+        self._lastCheck = time.time()
+        used = self.usage()
+        self.peak = max(self.peak, used)
+        if enforce and self._budget and used > self._budget:
+            raise scratchError('Scratch space {} uses {:.0f} MB, over the budget of {:.0f} MB'.format(self.root, used / 2.**20, self._budget / 2.**20))
+
+
+class buildScheduler(object):
+    """
+    buildScheduler: a small process scheduler running queued commands, at most maxJobs at a time, each with its output captured in its own log file.
+
+    A command may wait for others to finish first; it is skipped if any of them failed.
+    """
+
+    def __init__(self, maxJobs=2, logger=None, poll=0.2, monitor=None, trace=None):
+        """
+        :arg maxJobs: the number of commands run at the same time
+        :arg logger: logger for progress messages
+        :arg poll: interval in seconds at which running commands are checked
+        :arg monitor: optional callable, called at each check; if it raises, the running commands are stopped and the exception passed on
+        :arg trace: timingTrace recording each job, on a lane per job slot
+        """
+        self._maxJobs = max(1, maxJobs)
+        self._logger = logger or logging.getLogger(__name__)
+        self._poll = poll
+        self._monitor = monitor
+        self._trace = trace or timingTrace()
+        self._slots = {} # slot of each running job
+        self._queue = collections.deque()
+
+    def submit(self, name, cmd, cwd, logfile, stdout=None, after=()):
+        """ Queue a command
+
+        :param name: name of the job, for messages and the results
+        :param cmd: the command, as a list
+        :param cwd: the directory to run it in
+        :param logfile: the file receiving its standard error, and its standard output unless stdout is given
+        :param stdout: optional file receiving its standard output
+        :param after: names of the jobs that must succeed before this one starts
+        """
+        self._queue.append((name, cmd, cwd, logfile, stdout, tuple(after)))
+
+    @staticmethod
+    def program(cmd):
+        """ The program a command runs, for the timing summary: the script, for the ones run by perl """
+        return Path(cmd[1 if cmd[0] == 'perl' and len(cmd) > 1 else 0]).name
+
+    def start(self, job):
+        """ Start a job
+
+        :return: (process, open files, log file, start time), or None if it could not be started
+        """
+        (name, cmd, cwd, logfile, stdout, after) = job
+        log = open(logfile, 'w')
+        out = open(stdout, 'w') if stdout else log
+        self._logger.debug('Starting %s in %s: %s', name, cwd, ' '.join(cmd))
+        try:
+            return (subprocess.Popen(cmd, cwd=str(cwd), stdout=out, stderr=log if stdout else subprocess.STDOUT), {log, out}, logfile, time.time())
+        except OSError as e:
+            log.write('Could not start {}: {}\n'.format(cmd[0], e))
+            for f in {log, out}:
+                f.close()
+            return None
+
+    def run(self):
+        """ Run all the queued commands
+
+        :return: ordered dictionary of name: (return code, log file, wall time), in submission order. The return code is None for
+                 jobs skipped because one they waited for failed.
+        """
+        results = collections.OrderedDict((job[0], None) for job in self._queue)
+        running = {}
+        try:
+            self.schedule(results, running)
+        except BaseException:
+            for (name, (proc, files, logfile, t0)) in running.items():
+                self._logger.debug('Stopping %s', name)
+                proc.terminate()
+                proc.wait()
+                self._trace.add(name, 'job', t0, time.time() - t0, key=buildScheduler.program(proc.args), lane=self._slots.pop(name, 0), code=proc.returncode)
+                for f in files:
+                    f.close()
+            raise
+        return results
+
+    @staticmethod
+    def poll(proc):
+        """ As proc.poll(), with the resources the process used where os.wait4 is available (Unix)
+
+        :param proc: a running subprocess.Popen
+        :return: (pid, resource usage or None) once the process finished, with proc.returncode set; (0, None) while it runs
+        """
+        if not hasattr(os, 'wait4'):
+            return (proc.pid, None) if proc.poll() is not None else (0, None)
+        (pid, status, usage) = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            # as os.waitstatus_to_exitcode (Python 3.9): negative signal number if killed
+            proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        return (pid, usage)
+
+    def schedule(self, results, running):
+        """ The scheduling loop of run: start the jobs that can start, collect the ones that finished, until all are done
+
+        :param results: the results so far, by job name, updated
+        :param running: the running jobs, by job name, updated
+        """
+        while self._queue or running:
+            if self._monitor:
+                self._monitor()
+            waiting = collections.deque()
+            while self._queue:
+                job = self._queue.popleft()
+                (name, logfile, after) = (job[0], job[3], job[5])
+                if any(results.get(a) is not None and results[a][0] != 0 for a in after):
+                    self._logger.debug('Skipping %s: %s failed', name, ', '.join(a for a in after if results[a][0] != 0))
+                    results[name] = (None, logfile, 0.)
+                elif len(running) < self._maxJobs and all(results.get(a) is not None for a in after):
+                    started = self.start(job)
+                    if started:
+                        running[name] = started
+                        self._slots[name] = min(set(range(1, self._maxJobs + 1)) - set(self._slots.values()))
+                    else:
+                        results[name] = (-1, logfile, 0.)
+                else:
+                    waiting.append(job)
+            self._queue = waiting
+            for (name, (proc, files, logfile, t0)) in list(running.items()):
+                (pid, usage) = buildScheduler.poll(proc)
+                if pid:
+                    output = sum(timingTrace.outputSize(f) or 0 for f in files)
+                    for f in files:
+                        f.close()
+                    del running[name]
+                    results[name] = (proc.returncode, logfile, time.time() - t0)
+                    slot = self._slots.pop(name)
+                    self._trace.lane(slot, 'job slot {}'.format(slot))
+                    self._trace.add(name, 'job', t0, results[name][2], key=buildScheduler.program(proc.args),
+                                    lane=slot, cpu=usage.ru_utime + usage.ru_stime if usage else None, code=proc.returncode, output=output)
+                    self._logger.debug('Finished %s (exit %d) in %.1f s', name, proc.returncode, results[name][2])
+            if running:
+                time.sleep(self._poll)
+            elif self._queue and not any(all(results.get(a) is not None for a in job[5]) for job in self._queue):
+                raise ValueError('Jobs waiting for jobs never submitted: {}'.format(', '.join(job[0] for job in self._queue)))
+
 
 class tdrDiff(object):
     """
@@ -43,7 +1048,7 @@ class tdrDiff(object):
 
     accessString = {'http': 'https://gitlab.cern.ch/tdr/', 'ssh': 'ssh://git@gitlab.cern.ch:7999/tdr/', 'krb': 'https://:@gitlab.cern.ch:8443/tdr/'}
 
-    def __init__(self, docTag, docPath='papers',  revDiff='HEAD~1', verbosity=0, accessType='ssh', outfile=None, revBase='HEAD', logfile=None, plotsFromRevBase=False):
+    def __init__(self, docTag, docPath='papers',  revDiff='HEAD~1', verbosity=0, accessType='ssh', outfile=None, revBase='HEAD', logfile=None, plotsFromRevBase=False, cacheDir=None, parallel=False, useCache=True, cacheSize=1024, fullDiff=False, tmpfs=False, scratchBudget=None, keep=(), keepScratch=False, trace=None, fullClone=False, markFigures=False):
         """
         :arg docTag: the document name, eg, HIG-19-001
         :arg docType: the document type, note or paper:
@@ -53,15 +1058,39 @@ class tdrDiff(object):
         :arg outfile: file name for output PDF
         :arg revBase: the base revision
         :arg logFile: optional file to store log output
+        :arg cacheDir: directory for the persistent repository mirrors. Default: $XDG_CACHE_HOME/tdrDiff
+        :arg parallel: build the exports of the two revisions at the same time
+        :arg useCache: reuse the exports of already built commits
+        :arg cacheSize: size limit in MB of the export cache, in cacheDir/exports
+        :arg fullDiff: always run latexdiff on the whole document, rather than on the changed inputs or sections only
+        :arg tmpfs: put the scratch space on /dev/shm when there is room
+        :arg scratchBudget: disk budget of the scratch space in MB; the run stops if it goes over
+        :arg keep: glob patterns of scratch files to keep, copied to <tag>_artifacts
+        :arg keepScratch: do not remove the scratch space after the run
+        :arg trace: file to write a timing trace of the run to, in the Chrome trace format
+        :arg fullClone: mirror the whole repository, rather than a shallow partial clone with sparse worktrees
+        :arg markFigures: frame the figures that changed between the revisions in the diff PDF
         """
 
         self._t0  = time.time()
+        self._trace = timingTrace(self._t0)
+        self._traceFile = trace
         self._docTag = docTag
         self._revBase = revBase
         self._revDiff = revDiff
         self._plotsFromRevBase = plotsFromRevBase
+        self._parallel = parallel
+        self._fullDiff = fullDiff
+        self._markFigures = markFigures
+        self._tmpfs = tmpfs
+        self._scratchBudget = scratchBudget
+        self._keep = keep
+        self._keepScratch = keepScratch
+        self._scratch = None # the scratchSpace of the run in progress
         if accessType in tdrDiff.accessString.keys():
             self._url = tdrDiff.accessString[accessType]+docPath+'/'+docTag
+        elif Path(accessType).exists(): # a local repository
+            self._url = str(Path(accessType).resolve())
         else:
             if urllib.parse.urlparse(accessType):
                 self._url = accessType
@@ -84,6 +1113,29 @@ class tdrDiff(object):
             self._logger.addHandler(self._flogger)
         self._logger.debug('#### Start: %s. Target: %s', datetime.datetime.utcnow().replace(tzinfo=pytz.UTC).strftime('%Y-%m-%d %H:%M %Z'), docTag)
         self.versionCheck()
+        if not cacheDir:
+            cacheDir = Path(os.environ.get('XDG_CACHE_HOME', Path.home()/'.cache'))/'tdrDiff'
+        if not fullClone and self._gitVersion < repoMirror.leanGitVersion:
+            self._logger.info('Git %s is too old for shallow, blobless clones with sparse checkouts (needs %s): cloning the full repository',
+                              '.'.join(map(str, self._gitVersion)), '.'.join(map(str, repoMirror.leanGitVersion)))
+            fullClone = True
+        if fullClone:
+            self._mirror = repoMirror(self._url, cacheDir, self._git, self._logger, self._procout, trace=self._trace)
+        else:
+            self._mirror = repoMirror(self._url, cacheDir, self._git, self._logger, self._procout, trace=self._trace,
+                                      filter='blob:none', depth=tdrDiff.historyDepth([revBase, revDiff]), sparse=True)
+        self._exports = exportCache(Path(cacheDir)/'exports', cacheSize, self._logger) if useCache else None
+        self._builds = latexmkCache(Path(cacheDir)/'latexmk', logger=self._logger) if useCache else None
+
+    @staticmethod
+    def historyDepth(revs):
+        """ The history depth that covers the revisions given relative to HEAD, e.g. HEAD~3; the others are fetched when needed """
+        depth = 1
+        for rev in revs:
+            m = re.match(r'^HEAD((?:[~^]\d*)*)$', rev)
+            if m: # ~N goes back N generations, ^N to the Nth parent, one generation
+                depth = max(depth, 1 + sum(int(n or 1) if op == '~' else 1 for (op, n) in re.findall(r'([~^])(\d*)', m.group(1))))
+        return depth
 
     def versionCheck(self):
         """ find the locations of the required external programs and do sanity checks
@@ -100,6 +1152,7 @@ class tdrDiff(object):
                 exit()
             else:
                 self._git = Path(git)
+                self._gitVersion = (int(major), int(minor))
         
         # python version
         (major, minor, *_) = sys.version_info
@@ -126,95 +1179,399 @@ class tdrDiff(object):
         self._lmk = lmk
         self._latexdiff = latexdiff
  
-    def goToWorkDir(self, workDir):
-        """ Use a temporary area to avoid overwriting the current checked out repo
+    def checkout(self, workDir, rev='HEAD'):
+        """ Use a temporary area to avoid overwriting the current checked out repo: a worktree of the local mirror of the repository
         :param workDir: the directory to work in 
+        :param rev: the revision to check out
+        :return: the path of the checked out tree
         """
-        os.chdir(workDir) # starting work area
         self._logger.info("Temporarily working in %s", workDir)
-        self._logger.info("Cloning...")
-        # clone HEAD
-        subprocess.run([str(self._git), 'clone','--recursive', self._url], check=True, stdout=self._procout, stderr=self._procout)
-        self._logger.debug("Checked out %s", self._url)
-        os.chdir(self._docTag)
+        self._logger.info("Checking out %s...", rev)
+        worktree = self._mirror.worktree(rev, Path(workDir)/self._docTag)
+        self._logger.debug("Checked out %s of %s", rev, self._url)
+        return worktree
 
+    def buildExports(self, workDir, builds, maxJobs=None):
+        """ Run tdr --export in each tree, one after the other, or all at once in parallel mode. The output of each build goes to its own log.
 
-    def differ(self):
-        """ Do the work. All arguments taken from class 
-        
-        :return: copies the output PDF file to self._outfile
+        :param workDir: where to put the build logs
+        :param builds: list of (label, rev, tree)
+        :param maxJobs: the number of builds run at the same time, overriding the parallel mode
+        :return: True if all the builds succeeded
+        """
+        if not maxJobs:
+            maxJobs = len(builds) if self._parallel else 1
+        scheduler = self.scheduler(maxJobs)
+        args = ['--export', '--admin=nolineno', 'b', self._docTag]
+        keys = {}
+        for (label, rev, tree) in builds:
+            if self._exports and tree != self._startDir: # the current directory may have uncommitted changes
+                sha = self._mirror.run('rev-parse', 'HEAD', cwd=tree, stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+                keys[label] = exportCache.key(self._docTag, sha, self._tdrExe, args)
+                if self._exports.fetch(keys[label], tree/'export'):
+                    self._logger.info('Reusing the cached export of %s rev %s (%s)', label, rev, sha[:12])
+                    continue
+            scheduler.submit(label, ['perl', str(self._tdrExe)] + args, tree, Path(workDir)/'build_{}.log'.format(label))
+        ok = True
+        trees = dict((label, (rev, tree)) for (label, rev, tree) in builds)
+        results = scheduler.run()
+        # the sparse checkout picks the figures by the names in the text files: a figure found otherwise (\graphicspath, names built by macros)
+        # is missing, and the build fails. Those builds get a second chance with all the files.
+        scheduler = self.scheduler(maxJobs)
+        for (label, (code, logfile, wall)) in list(results.items()):
+            if code != 0 and self._mirror.sparse(trees[label][1]):
+                self._logger.warning('Build of %s rev %s failed in a sparse checkout, which may lack figures: building again with all the files',
+                                     label, trees[label][0])
+                self._mirror.fullCheckout(trees[label][1])
+                scheduler.submit(label, ['perl', str(self._tdrExe)] + args, trees[label][1], Path(workDir)/'build_{}_full.log'.format(label))
+        results.update(scheduler.run())
+        for (label, (code, logfile, wall)) in results.items():
+            (rev, tree) = trees[label]
+            if self._procout is None: # high verbosity: echo the build output
+                print(Path(logfile).read_text(errors='replace'))
+            if code != 0:
+                ok = False
+                tail = Path(logfile).read_text(errors='replace').splitlines()[-20:]
+                self._logger.error('Build of %s rev %s failed (exit %d). Full log in %s; it ends with:\n%s', label, rev, code, logfile, '\n'.join(tail))
+            else:
+                self._logger.debug("Built %s rev %s of %s in %.1f s (log in %s)", label, rev, self._docTag, wall, logfile)
+                if label in keys and (tree/'export').is_dir():
+                    self._exports.store(keys[label], tree/'export')
+        return ok
+
+
+    def scheduler(self, maxJobs):
+        """ A buildScheduler for this run, holding the scratch space to its budget while commands run """
+        return buildScheduler(maxJobs, self._logger, monitor=self._scratch.check if self._scratch else None, trace=self._trace)
+
+    def scratchSpace(self):
+        """ The scratch space for a run, as set up by the options """
+        return scratchSpace('tdrDiff_', self._tmpfs, self._scratchBudget, self._keep, self._startDir/(self._docTag + '_artifacts'), self._keepScratch, self._logger)
+
+    def leaveScratch(self):
+        """ After the scratch space of a run is gone: back to the starting directory, and drop the worktrees it held from the mirror """
+        os.chdir(str(self._startDir))
+        self._scratch = None
+        try:
+            self._mirror.run('worktree', 'prune')
+        except (OSError, subprocess.CalledProcessError):
+            self._logger.debug('Could not prune the worktrees of %s', self._mirror.path)
+
+    def traceReport(self):
+        """ At the end of a run: time it as a whole, then write the trace if asked for, and show the summary """
+        self._trace.add(self._docTag, 'run', self._t0, time.time() - self._t0, key='total', cpu=timingTrace.cpu())
+        if self._traceFile:
+            self._trace.write(self._traceFile)
+            print('Timing trace written to {}\n{}'.format(self._traceFile, self._trace.summary()))
+        else:
+            self._logger.info('Timing summary:\n%s', self._trace.summary())
+
+    def latexdiffCommand(self, old, new, flatten=True):
+        """ The latexdiff command for two TeX files; it writes the difference document to standard output
+
+        :param flatten: include the input files in the comparison
+        """
+        return [str(self._latexdiff), '--verbose'] + (['--flatten'] if flatten else []) + [str(old), str(new)]
+
+    def planUnitDiff(self, old, new, where):
+        """ Prepare a diff of two exports unit by unit (see texUnits), so that latexdiff only works on what changed.
+            Unchanged units are copied through as they are; the changed units and the document skeleton are left for latexdiff, whose
+            commands are returned: they are independent and can run in parallel. Together they write <tag>_diff.tex in where.
+
+        :param old: the export of the older revision
+        :param new: the export of the newer revision
+        :param where: the directory the diff document is built in
+        :return: list of (label, latexdiff command, output file); None if the two documents do not split into the same units, or if a
+                 file input in the preamble changed, which only a whole-document diff shows
         """
+        docName = self._docTag + '_temp.tex'
+        splits = [texUnits((export/docName).read_text(encoding='latin-1'), export) for export in (old, new)]
+        if None in splits or splits[0][0] != splits[1][0] or splits[0][1] != splits[1][1]:
+            self._logger.info('The revisions do not split into the same units: diffing the whole document')
+            return None
+        if splits[0][4] != splits[1][4]:
+            self._logger.info('A file input in the preamble changed: diffing the whole document')
+            return None
+        names = ['{}_diff_unit{:03d}'.format(self._docTag, k) for k in range(len(splits[0][3]))]
+        jobs = []
+        changed = 0
+        for (k, (name, oldText, newText)) in enumerate(zip(names, splits[0][3], splits[1][3])):
+            if hashlib.sha256(oldText.encode('latin-1')).digest() == hashlib.sha256(newText.encode('latin-1')).digest():
+                writeFresh(where/(name + '.tex'), newText)
+                continue
+            changed += 1
+            # each side next to its own export, so that anything it inputs in turn is found there
+            writeFresh(old/(name + '_old.tex'), oldText)
+            writeFresh(new/(name + '_new.tex'), newText)
+            jobs.append(('unit{:03d}'.format(k), self.latexdiffCommand(old/(name + '_old.tex'), new/(name + '_new.tex')), where/(name + '.tex')))
+        writeFresh(old/(self._docTag + '_skeleton_old.tex'), splits[0][2](names))
+        writeFresh(new/(self._docTag + '_skeleton_new.tex'), splits[1][2](names))
+        jobs.insert(0, ('skeleton', self.latexdiffCommand(old/(self._docTag + '_skeleton_old.tex'), new/(self._docTag + '_skeleton_new.tex'), flatten=False),
+                        where/(self._docTag + '_diff.tex')))
+        self._logger.info('Split the document into %d units by %s: %d changed', len(names), splits[0][0], changed)
+        return jobs
+
+    def unitDiff(self, old, new, where, workDir):
+        """ Diff two exports unit by unit, running latexdiff on the changed units in parallel
+
+        :param old: the export of the older revision
+        :param new: the export of the newer revision
+        :param where: the directory the diff document is built in
+        :param workDir: where to put the latexdiff logs
+        :return: True if <tag>_diff.tex was written; False if a full diff is needed instead
+        """
+        jobs = self.planUnitDiff(old, new, where)
+        if jobs is None:
+            return False
+        scheduler = self.scheduler(os.cpu_count() or 1)
+        for (label, cmd, out) in jobs:
+            if out.exists():
+                out.unlink()
+            scheduler.submit(label, cmd, where, Path(workDir)/'latexdiff_{}.log'.format(label), stdout=out)
+        failed = [label for (label, (code, logfile, wall)) in scheduler.run().items() if code != 0]
+        if failed:
+            self._logger.warning('latexdiff failed on %s: diffing the whole document instead', ', '.join(failed))
+            return False
+        return True
 
+    def stageFigures(self, preferred, other, where, old, new):
+        """ Stage the merged tree of two exports, in which the diff document is built, and find the figures that changed
 
-        #
-        workDir = Path(tempfile.mkdtemp(prefix='tdrDiff_')) # this is a "permanent" temporary directory. It is not automatically deleted after use.
+        :param preferred: the export whose figures are used where both have one
+        :param other: the other export
+        :param where: the merged tree to create
+        :param old: the export of the older revision
+        :param new: the export of the newer revision
+        :return: the figures changed or added between the revisions, as paths relative to the exports
+        """
+        counts = stageTree(preferred, other, where)
+        (changed, added, removed) = figureChanges(old, new)
+        self._logger.info('Staged %s: %d files linked, %d from the other revision; figures: %d changed, %d added, %d removed',
+                          where.name, counts[0], counts[1], len(changed), len(added), len(removed))
+        for (what, figures) in (('Changed', changed), ('Added', added), ('Removed', removed)):
+            if figures:
+                self._logger.debug('%s figures: %s', what, ', '.join(figures))
+        return changed + added
+
+    def latexmkCommand(self, diffile, outDir=None):
+        """ The latexmk command producing the PDF of a difference document, in outDir if given """
+        outDir = ['-outdir={}'.format(outDir)] if outDir else []
+        return [str(self._lmk), '-pdf', '-f', '-latexoption="-interaction=batchmode"'] + outDir + [str(diffile)] # batchmode runs over errors, -f forces latexmk to proceed
 
-        if (self._revBase != '.'):
-            self.goToWorkDir(workDir)
+    def latexmkDir(self, old, new, where):
+        """ The persistent latexmk build directory of a revision pair, compiled in where; None without the cache """
+        if not self._builds:
+            return None
+        return self._builds.directory(self._docTag, old, new, latexmkCache.stamp(where, self._lmk))
 
+    def seriesRevisions(self, revs):
+        """ Resolve the revisions of a series
+
+        :param revs: a single range, A..B, meaning A and the commits after it up to B (first parents only), or an explicit list
+        :return: list of (rev, SHA), oldest first as given, without repeats
+        """
+        self._mirror.update()
+        if len(revs) == 1 and '..' in revs[0]:
+            (start, end) = revs[0].split('..', 1)
+            self._mirror.complete() # a range needs the history in between
+            proc = self._mirror.run('rev-list', '--reverse', '--first-parent', revs[0], stdout=subprocess.PIPE)
+            revs = [start] + proc.stdout.decode('utf-8').split()
+        series = []
+        for rev in revs:
+            sha = self._mirror.commit(rev)
+            if sha not in [s for (r, s) in series]:
+                series.append((rev, sha))
+        return series
 
-            # optionally change from HEAD to a different base commit (revBase)
-            if self._revBase != 'HEAD' and self._revBase != '.':
-                subprocess.run([str(self._git), 'checkout', self._revBase], check=True, stdout=self._procout, stderr=self._procout)
-            self._logger.debug("Checked out out base rev %s", self._revBase)
+    def series(self, revs, jobs=None):
+        """ Diff each adjacent pair of a series of revisions. Each revision is checked out and exported once, however many pairs it is in;
+            the exports, then the latexdiff and latexmk runs, share a pool of jobs worker processes.
 
-        # build the export directory for the base
-        self._logger.info("Building export directories...")
+        :param revs: the revisions, as for seriesRevisions
+        :param jobs: the number of worker processes. Default: the number of CPUs
+        :return: list of (older SHA, newer SHA, PDF or None), for the pairs in order. The PDFs, and an index of them, are copied to the
+                 output directory: self._outfile, or <tag>_series in the starting directory.
+        """
         try:
-            subprocess.run(['perl', str(self._tdrExe), '--export', '--admin=nolineno', 'b', self._docTag], check=True, stdout=self._procout)
-        except subprocess.CalledProcessError as e:
-            self._logger.exception('Problems running rev %s. Full error message follows.',self._revBase)
-            print(e.output)
-        self._logger.debug("Built %s rev of %s", self._revBase, self._docTag)
-        workDir0 = Path(tempfile.mkdtemp(prefix='tdrDiff2_'))
-        #
-        export0 = workDir0/'export0' # move export directory to new work area
-        os.rename('export',export0)
-        self._logger.debug('Output of %s rev build moved to %s', self._revBase, Path(export0))
+            with self.scratchSpace() as self._scratch:
+                return self.seriesIn(self._scratch.root, revs, jobs)
+        finally:
+            self.leaveScratch()
+            self.traceReport()
+
+    def seriesIn(self, workDir, revs, jobs=None):
+        """ The work of series(), in the work area workDir """
+        jobs = jobs or os.cpu_count() or 1
+        with self._trace.phase('resolve'):
+            series = self.seriesRevisions(revs)
+        if len(series) < 2:
+            self._logger.error('A series needs at least two different revisions, got %s', ', '.join(r for (r, s) in series) or 'none')
+            return []
+        self._logger.info('Diffing a series of %d revisions in %d pairs', len(series), len(series) - 1)
+
+        # every revision once
+        with self._trace.phase('checkout'):
+            builds = [('r{}_{}'.format(i, sha[:8]), rev, self.checkout(workDir/'r{}_{}'.format(i, sha[:8]), sha)) for (i, (rev, sha)) in enumerate(series)]
+        self._logger.info('Building %d export directories on %d workers...', len(builds), jobs)
+        with self._trace.phase('export'):
+            self.buildExports(workDir, builds, jobs)
+        self._scratch.check(force=True)
+
+        # then every pair: latexdiff, followed by latexmk, in a merged tree of the two exports
+        docName = self._docTag + '_temp.tex'
+        diffile = self._docTag + '_diff.tex'
+        scheduler = self.scheduler(jobs)
+        pairs = []
+        staged = [] # (name, where, build directory, latexdiff jobs, changed figures)
+        for i in range(len(builds) - 1):
+            (oldSha, newSha) = (series[i][1], series[i+1][1])
+            (old, new) = (builds[i][2]/'export', builds[i+1][2]/'export')
+            if not (old.is_dir() and new.is_dir()):
+                self._logger.error('Skipping pair %d (%s..%s): missing export', i + 1, oldSha[:8], newSha[:8])
+                pairs.append((oldSha, newSha, None))
+                continue
+            name = 'pair{}'.format(i + 1)
+            where = workDir/name
+            changed = self.stageFigures(new if self._plotsFromRevBase else old, new if not self._plotsFromRevBase else old, where, old, new)
+            units = None if self._fullDiff else self.planUnitDiff(old, new, where)
+            if units is None:
+                units = [('latexdiff', self.latexdiffCommand(old/docName, new/docName), where/diffile)]
+            for (label, cmd, out) in units:
+                scheduler.submit('{}_{}'.format(name, label), cmd, where, workDir/'{}_{}.log'.format(name, label), stdout=out)
+            outDir = self.latexmkDir(oldSha, newSha, where)
+            staged.append((name, where, outDir, ['{}_{}'.format(name, label) for (label, cmd, out) in units], changed))
+            pairs.append((oldSha, newSha, (outDir or where)/(self._docTag + '_diff.pdf')))
+        self._logger.info('Running latexdiff and latexmk for %d pairs...', len(pairs))
+        with self._trace.phase('diff'):
+            results = collections.OrderedDict()
+            if self._markFigures: # the diff documents are marked up between latexdiff and latexmk
+                results.update(scheduler.run())
+                scheduler = self.scheduler(jobs)
+            for (name, where, outDir, after, changed) in staged:
+                if self._markFigures:
+                    if any(results[a][0] != 0 for a in after):
+                        results[name + '_latexmk'] = (None, workDir/(name + '_latexmk.log'), 0.)
+                        continue
+                    if changed:
+                        markFigures(where/diffile, changed)
+                    after = []
+                scheduler.submit(name + '_latexmk', self.latexmkCommand(diffile, outDir), where, workDir/(name + '_latexmk.log'), after=after)
+            results.update(scheduler.run())
+        for (name, (code, logfile, wall)) in results.items():
+            if code != 0:
+                self._logger.warning('%s %s; see %s', name, 'skipped' if code is None else 'failed (exit {})'.format(code), logfile)
+            elif name.endswith('_latexmk'):
+                self._logger.info('latexmk for %s: %s in %.1f s', name[:-len('_latexmk')], latexmkCache.report(latexmkCache.passes(logfile)), wall)
 
-        if (self._revBase == '.'):
-            self.goToWorkDir(workDir)
+        # collect the PDFs, and index them
+        outDir = Path(self._outfile) if self._outfile else self._startDir/(self._docTag + '_series')
+        outDir.mkdir(parents=True, exist_ok=True)
+        subjects = dict((sha, self._mirror.run('log', '-1', '--format=%h %s', sha, stdout=subprocess.PIPE).stdout.decode('utf-8').strip()) for (rev, sha) in series)
+        results = []
+        rows = []
+        for (i, (oldSha, newSha, pdf)) in enumerate(pairs):
+            if pdf and pdf.exists():
+                dest = outDir/'{}_diff_{:03d}_{}_{}.pdf'.format(self._docTag, i + 1, oldSha[:8], newSha[:8])
+                shutil.copy(str(pdf), str(dest))
+                link = '<a href="{0}">{0}</a>'.format(dest.name)
+            else:
+                (dest, link) = (None, 'failed')
+            results.append((oldSha, newSha, dest))
+            rows.append('<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>'.format(i + 1, html.escape(subjects[oldSha]), html.escape(subjects[newSha]), link))
+        index = outDir/'index.html'
+        index.write_text('<html><head><title>{0} diff series</title></head><body>\n<h1>{0}: {1} revisions</h1>\n<table>\n'
+                         '<tr><th>#</th><th>from</th><th>to</th><th>diff</th></tr>\n{2}\n</table>\n</body></html>\n'.format(
+                             html.escape(self._docTag), len(series), '\n'.join(rows)))
+        print("Copied {} of {} latexdiff outputs to {}; index in {}".format(sum(1 for r in results if r[2]), len(results), outDir, index))
+        return results
 
-        # now get diff revision to differ against
-        subprocess.run([str(self._git), 'checkout', self._revDiff], check=True, stdout=self._procout, stderr=self._procout)
-        self._logger.debug("Checked out out rev %s", self._revDiff)
-        # and build document
+    def differ(self):
+        """ Do the work. All arguments taken from class 
+        
+        :return: copies the output PDF file to self._outfile
+        """
         try:
-            subprocess.run(['perl', str(self._tdrExe), '--export', '--admin=nolineno', 'b', self._docTag], check=True, stdout=self._procout)  
-        except subprocess.CalledProcessError as e:
-            self._logger.exception('Problems running rev %s. Full error message follows.',self._revDiff)
-            print(e.output)
-        self._logger.debug("Built  rev %s", self._revDiff)
-        export1 = Path().absolute()/'export'
-
-        # Choose where plots should be from
-        if self._plotsFromRevBase: os.chdir(export0) # need to work in directory with all TeX includes. Go to revBase
-        else: os.chdir(export1) # need to work in directory with all TeX includes. Go to revDiff
+            with self.scratchSpace() as self._scratch:
+                self.differIn(self._scratch.root)
+        finally:
+            self.leaveScratch()
+            self.traceReport()
+
+    def differIn(self, workDir):
+        """ The work of differ(), in the work area workDir, which is removed afterwards """
+
+        # check out both revisions in trees of their own: a base of "." is the current directory
+        with self._trace.phase('checkout'):
+            if (self._revBase != '.'):
+                baseTree = self.checkout(workDir/'base', self._revBase)
+                self._logger.debug("Checked out out base rev %s", self._revBase)
+            else:
+                baseTree = self._startDir
+            diffTree = self.checkout(workDir/'diff', self._revDiff)
+            self._logger.debug("Checked out out rev %s", self._revDiff)
+
+        # build the export directories
+        self._logger.info("Building export directories%s...", " in parallel" if self._parallel else "")
+        with self._trace.phase('export'):
+            self.buildExports(workDir, [('base', self._revBase, baseTree), ('diff', self._revDiff, diffTree)])
+        self._scratch.check(force=True)
+        for (label, tree) in (('base', baseTree), ('diff', diffTree)):
+            if not (tree/'export').is_dir():
+                self._logger.error('No export directory from the %s build: giving up', label)
+                return
+        export0 = workDir/'export0' # move export directory out of the base tree, which may be the current directory
+        shutil.move(str(baseTree/'export'), str(export0)) # across file systems, from the current directory to a tmpfs scratch space
+        self._logger.debug('Output of %s rev build moved to %s', self._revBase, Path(export0))
+        export1 = diffTree/'export'
+
+        # work in a merged tree of both exports, linked rather than copied, with the plots of revDiff unless asked otherwise
+        with self._trace.phase('stage'):
+            if self._plotsFromRevBase:
+                changed = self.stageFigures(export0, export1, workDir/'merged', export1, export0)
+            else:
+                changed = self.stageFigures(export1, export0, workDir/'merged', export1, export0)
+        os.chdir(workDir/'merged') # need to work in directory with all TeX includes
         # generate the diference document between the two revisions
         self._logger.debug('Now working in %s',Path.cwd())
         docName = self._docTag + '_temp.tex'
         diffile = Path(self._docTag +'_diff.tex') # the TeX file of differences
         self._logger.info("Running latexdiff...")
-        with open(diffile, mode='w') as out:
-            try:
-                subprocess.run([str(self._latexdiff), '--verbose', '--flatten', str(export1/docName), str(export0/docName)], stdout=out, stderr=subprocess.PIPE)
-            except subprocess.CalledProcessError as e:
-                self._logger.exception('Problems running latexdiff. Full error message follows.')
-                print(e.output)
+        with self._trace.phase('latexdiff'):
+            if self._fullDiff or not self.unitDiff(export1, export0, Path.cwd(), workDir):
+                with open(diffile, mode='w') as out:
+                    try:
+                        self._trace.run(self.latexdiffCommand(export1/docName, export0/docName), stdout=out, stderr=subprocess.PIPE)
+                    except subprocess.CalledProcessError as e:
+                        self._logger.exception('Problems running latexdiff. Full error message follows.')
+                        print(e.output)
+        if self._markFigures and changed and not markFigures(diffile, changed):
+            self._logger.warning('Could not mark the changed figures: no \\begin{document} in %s', diffile)
+        self._scratch.check(force=True)
 
-        # and convert the difference TeX to PDF        
+        # and convert the difference TeX to PDF, in the build directory kept from earlier runs for the same revisions
         self._logger.info('Running latexmk...')
+        outDir = self.latexmkDir(self._mirror.commit(self._revDiff), 'worktree' if self._revBase == '.' else self._mirror.commit(self._revBase), Path.cwd())
+        warm = outDir and any(path.name != '.tdrDiff-stamp' for path in outDir.iterdir())
+        logfile = workDir/'latexmk.log'
+        t0 = time.time()
         try:
-            subprocess.run([str(self._lmk), '-pdf', '-f', '-latexoption="-interaction=batchmode"', str(diffile)], check=True, stdout=self._procout, stderr=subprocess.PIPE) # batchmode runs over errors, -f forces latexmk to proceed
+            with self._trace.phase('latexmk'), open(logfile, 'w') as log:
+                self._trace.run(self.latexmkCommand(diffile, outDir), check=True, stdout=log, stderr=subprocess.STDOUT) # batchmode runs over errors, -f forces latexmk to proceed
+            if self._procout is None:
+                print(Path(logfile).read_text(errors='replace'))
+            self._logger.info('latexmk: %s in %.1f s%s', latexmkCache.report(latexmkCache.passes(logfile)), time.time() - t0,
+                              ' in the {} build directory {}'.format('kept' if warm else 'new', outDir) if outDir else '')
         except subprocess.CalledProcessError as e:
             self._logger.exception('Problems running latexmk. Full error message follows.')
-            print(e.output)
+            if self._procout is None:
+                print(Path(logfile).read_text(errors='replace'))
             print('[Note] Errors can be ignored, in the case there are new plots.')
             print('[Note] revBase plots can be used instead of revDiff plots with --plotsFromRevBase option.')
             print('Run again with verbosity > 2 to get error output from latexmk.')
+        self._scratch.check(force=True)
 
         # finally, copy the PDF back to the starting location
-        difpdf =  Path.cwd() / Path(self._docTag +'_diff.pdf') 
+        difpdf =  (outDir or Path.cwd()) / Path(self._docTag +'_diff.pdf') 
         os.chdir(self._startDir)
         if difpdf.exists():
             if self._outfile:
@@ -245,7 +1602,36 @@ def main(argv):
     parser.add_argument( '--revDiff', action='store', dest='revDiff', default="HEAD~1", 
                         help='revision for comparison. Defalut: HEAD~1. Accepts SHAs')
     parser.add_argument( '--plotsFromRevBase', action='store_true', dest='plotsFromRevBase',
-                        help='Use plots from revBase instead of revDiff')
+                        help='Use plots from revBase instead of revDiff, where both revisions have them. Figures only one revision has are always used')
+    parser.add_argument( '--markFigures', action='store_true', dest='markFigures',
+                        help='frame the figures that changed between the revisions in the diff PDF')
+    parser.add_argument( '--parallel', action='store_true', dest='parallel',
+                        help='build the base and diff revisions at the same time, in separate trees')
+    parser.add_argument( '--no-cache', action='store_false', dest='useCache',
+                        help='always build the exports and compile from scratch, without using or filling the export cache and the latexmk build directories')
+    parser.add_argument( '--cacheSize', action='store', dest='cacheSize', type=int, default=1024,
+                        help='size limit of the export cache in MB; least recently used exports are evicted. Default: 1024')
+    parser.add_argument( '--series', action='store', dest='series', nargs='+', metavar='REV',
+                        help='diff a series of revisions, pair by pair: a range (e.g. v1..HEAD, first parents only) or a list of revisions, oldest first. Each revision is built only once; --outfile names the output directory. Default directory: <tag>_series')
+    parser.add_argument( '-j', '--jobs', action='store', dest='jobs', type=int, default=None,
+                        help='number of worker processes in series mode. Default: number of CPUs')
+    parser.add_argument( '--fullDiff', action='store_true', dest='fullDiff',
+                        help='run latexdiff on the whole flattened document, rather than only on the \\input files (or sections) that changed')
+    parser.add_argument( '--tmpfs', action='store_true', dest='tmpfs',
+                        help='put the scratch space (work trees and exports) on the RAM-backed /dev/shm, if it has room')
+    parser.add_argument( '--scratchBudget', action='store', dest='scratchBudget', type=int, default=None,
+                        help='disk budget of the scratch space in MB; the run is stopped if it uses more. Default: no limit')
+    parser.add_argument( '--keep', action='append', dest='keep', default=[], metavar='PATTERN',
+                        help='keep the scratch files matching a glob pattern (e.g. "*.log", "*_diff.tex") in <tag>_artifacts; may be repeated')
+    parser.add_argument( '--keepScratch', action='store_true', dest='keepScratch',
+                        help='do not remove the scratch space after the run')
+    parser.add_argument( '--trace', action='store', dest='trace', metavar='FILE',
+                        help='write a timing trace of the run, phases and commands, to FILE in the Chrome trace format (chrome://tracing, Perfetto), and print a summary')
+    parser.add_argument( '--fullClone', action='store_true', dest='fullClone',
+                        help='mirror the whole repository history and check out all files. Default (with git 2.35 or later): a shallow, blobless clone, '
+                             'deepened as needed, with sparse checkouts of the text files and the figures they name. The figures are picked by the '
+                             'names in the text files, a heuristic: figures found through \\graphicspath or with names built by macros are missed, and '
+                             'only checked out when a failed export build is run again with all the files')
     parser.add_argument( '-p', '--path', action='store', dest='docPath', default='notes', choices=('notes','papers'),
                         help='path below tdr to the document: an, dn, etc. and PAS are all under notes. Default: notes')
     parser.add_argument(  '-l', '--logfile', action='store', dest='logfile', nargs='?', const='differLog.txt',
@@ -253,7 +1639,9 @@ def main(argv):
     parser.add_argument(  '--outfile', action='store', dest='outfile',
                         help='path for output PDF file; Default: <tag>_diff in cwd')
     parser.add_argument(  '--accessType', action='store', dest='accessType', default='ssh',
-                        help='git access type. It is assumed that the correct keys are already established [{}, {}, {}, arbitrary (full URL)]. Default: SSH'.format(*tdrDiff.accessString.keys()) )
+                        help='git access type. It is assumed that the correct keys are already established [{}, {}, {}, arbitrary (full URL or local path)]. Default: SSH'.format(*tdrDiff.accessString.keys()) )
+    parser.add_argument(  '--cacheDir', action='store', dest='cacheDir',
+                        help='directory for the local repository mirrors, which are reused and updated incrementally. Default: $XDG_CACHE_HOME/tdrDiff or ~/.cache/tdrDiff')
     parser.add_argument( 'tag', 
                         help='the document tag, eg, HIG-18-001')
 
@@ -263,8 +1651,11 @@ def main(argv):
     if opts.verbose:
         print('\tVerbosity = {}\n\n'.format(opts.verbose))
 
-    d = tdrDiff(opts.tag, opts.docPath, opts.revDiff, opts.verbose, opts.accessType, opts.outfile, opts.revBase, opts.logfile, opts.plotsFromRevBase)
-    d.differ()
+    d = tdrDiff(opts.tag, opts.docPath, opts.revDiff, opts.verbose, opts.accessType, opts.outfile, opts.revBase, opts.logfile, opts.plotsFromRevBase, opts.cacheDir, opts.parallel, opts.useCache, opts.cacheSize, opts.fullDiff, opts.tmpfs, opts.scratchBudget, opts.keep, opts.keepScratch, opts.trace, opts.fullClone, opts.markFigures)
+    if opts.series:
+        d.series(opts.series, opts.jobs)
+    else:
+        d.differ()
 
 
 
@@ -0,0 +1,68 @@
+""" Parse and rewrite parity of cleanRefs with the golden outputs of the original parser, on a small fixture bib """
+import collections
+import io
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cleanRefs
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def entries(filename):
+    """ The entries of a bib file, as {key: (artType, fields, entry text)}, in file order; the first of duplicate keys """
+    with io.open(filename, 'r', encoding='utf-8') as f:
+        text = f.read()
+    found = collections.OrderedDict()
+    for (artType, tag, items, span) in cleanRefs.tokenizeBib(text):
+        found.setdefault(tag, (artType, items, text[span[0]:span[1]]))
+    return found
+
+@pytest.fixture
+def baseDir(tmp_path):
+    for name in ('refs_temp.aux', 'refs_temp.blg'):
+        shutil.copy(os.path.join(data, name), str(tmp_path))
+    shutil.copy(os.path.join(data, 'refs.bib'), str(tmp_path/'auto_generated.bib'))
+    return tmp_path
+
+def parse(baseDir, cacheDir=None):
+    refs = cleanRefs.cleanRefs('refs', str(baseDir), 0, False, cacheDir)
+    refs.getRefList()
+    refs.getRefs()
+    return refs
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_parse(baseDir, tmp_path, cached):
+    with io.open(os.path.join(data, 'refs.parsed.json'), 'r', encoding='utf-8') as f:
+        golden = json.load(f)
+    cacheDir = str(tmp_path/'cache') if cached else None
+    if cached:
+        parse(baseDir, cacheDir) # cold run, fills the cache
+    refs = parse(baseDir, cacheDir)
+    assert dict((key, [artType, dict(fields)]) for (key, (artType, fields)) in refs._bib.items()) == golden
+    assert [tag for (tag, span) in refs._duplicates] == ['Twice']
+    assert refs._refs[-1] == 'Missing'
+
+def test_rewrite(baseDir):
+    refs = parse(baseDir)
+    refs.checkRefs()
+    refs.rewrite()
+    golden = entries(os.path.join(data, 'refs.rewritten.bib'))
+    original = entries(os.path.join(data, 'refs.bib'))
+    rewritten = entries(str(baseDir/'auto_generated.bib'))
+    assert list(rewritten) == list(golden) # the cited entries, in citation order
+    for (key, (artType, fields, text)) in rewritten.items():
+        assert (artType.upper(), fields) == golden[key][:2]
+        assert text in (golden[key][2], original[key][2]) # re-serialized as before, or copied verbatim
+
+def test_rewrite_keeps_line_ends(baseDir):
+    bib = baseDir/'auto_generated.bib'
+    bib.write_bytes(bib.read_bytes().replace(b'\n', b'\r\n'))
+    refs = parse(baseDir)
+    refs.rewrite()
+    raw = bib.read_bytes()
+    assert raw.count(b'\n') == raw.count(b'\r\n')
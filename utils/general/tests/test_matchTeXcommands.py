@@ -0,0 +1,52 @@
+""" Macro dependency closures of matchTeXcommands, with mutually recursive definitions """
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import matchTeXcommands
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'matchTeXcommands.py')
+
+defs = {
+	'\\ping': '\\pong{x}',
+	'\\pong': '\\ifx#1\\relax\\else\\ping\\fi\\leaf',
+	'\\uses': 'see \\ping',
+	'\\leaf': 'leaf',
+	'\\self': '\\self more',
+	'\\alone': 'nothing',
+}
+
+
+def test_cycle_is_one_component():
+	graph = matchTeXcommands.build_dep_graph(defs)
+	assert graph['\\self']==[] # self references are not dependencies
+	sccs = matchTeXcommands.find_sccs(graph)
+	assert sorted(sorted(scc) for scc in sccs if len(scc)>1)==[['\\ping', '\\pong']]
+	order = [cmd for scc in sccs for cmd in scc]
+	assert order.index('\\leaf')<order.index('\\ping')<order.index('\\uses') # components after those they depend on
+
+
+def test_closures():
+	closures = matchTeXcommands.dep_closures(matchTeXcommands.build_dep_graph(defs))
+	assert closures['\\ping']==closures['\\pong']==frozenset(['\\ping', '\\pong', '\\leaf'])
+	assert closures['\\uses']==frozenset(['\\ping', '\\pong', '\\leaf'])
+	assert closures['\\alone']==frozenset()
+	assert matchTeXcommands.commands_needed(closures, ['\\uses'])==set(['\\uses', '\\ping', '\\pong', '\\leaf'])
+
+
+def test_long_cycle():
+	name = lambda i: '\\c' + ''.join(chr(ord('a')+int(d)) for d in str(i)) # control sequence names are letters only
+	chain = dict((name(i), name((i+1)%2000)) for i in range(2000))
+	closures = matchTeXcommands.dep_closures(matchTeXcommands.build_dep_graph(chain))
+	assert all(len(needs)==2000 for needs in closures.values()) # no recursion limit on long chains
+
+
+def test_script(tmp_path):
+	tex = tmp_path/'paper.tex'
+	tex.write_text('\n'.join('\\newcommand{{{}}}[1][]{{{}}}'.format(cmd, body) for (cmd, body) in defs.items())
+	               + '\n\\cmsNoteHeader{X}\nText \\uses.\n')
+	out = subprocess.run([sys.executable, script, str(tex)], stdout=subprocess.PIPE, check=True).stdout.decode()
+	assert 'Warning: mutually recursive definitions: \\ping, \\pong' in out
+	unused = out.split('Commands unused anywhere:\n----------------\n')[1].split('----------------')[0].split()
+	assert sorted(unused)==['\\alone', '\\self']